@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+# Compare the cached APN attach template against encoding the whole
+# message with rpc.pack every time.
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rpc'))
+
+import rpc  # noqa: E402
+
+
+def main(number=2000):
+    apn = 'telstra.internet'
+    assert rpc.pack_UtaMsCallPsAttachApnConfigReq(apn) == \
+        rpc._build_UtaMsCallPsAttachApnConfigReq(apn)
+
+    slow = min(timeit.repeat(lambda: rpc._build_UtaMsCallPsAttachApnConfigReq(apn),
+                             number=number, repeat=3)) / number
+    fast = min(timeit.repeat(lambda: rpc.pack_UtaMsCallPsAttachApnConfigReq(apn),
+                             number=number, repeat=3)) / number
+
+    print('pack:     %8.2f us/msg' % (slow * 1e6))
+    print('template: %8.2f us/msg' % (fast * 1e6))
+    print('speedup:  %8.1fx' % (slow / fast))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# Bring-up and data path against the fake modem, for timing both without
+# the hardware.
+#
+#   bench_loopback.py bringup --latency 0.2 --ip-delay 3
+#   bench_loopback.py datapath --count 100000 --size 1400
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rpc'))
+
+import rpc  # noqa: E402
+import mux  # noqa: E402
+import fake_modem  # noqa: E402
+import rpc_timeline  # noqa: E402
+
+
+def bringup(args):
+    modem = fake_modem.FakeModem(latency=args.latency, ip_delay=args.ip_delay,
+                                 attach_failures=args.attach_failures)
+    steps = [
+        ('init services', rpc.init_services),
+        ('fcc unlock', rpc.do_fcc_unlock),
+        ('mode set', lambda r: rpc.UtaModeSet(r, 1)),
+        ('attach', lambda r: rpc.attach(r, 'internet')),
+        ('get ip', lambda r: rpc.wait_for_ip(r, args.ip_fetch_timeout)),
+        ('connect', rpc.connect_datachannel),
+    ]
+    timeline = rpc_timeline.Timeline()
+    with modem:
+        r = rpc.XMMRPC(interfaces=[modem.path], timeout=30)
+        r.timeline = timeline
+        for name, step in steps:
+            with timeline.phase(name):
+                step(r)
+        os.close(r.fp)
+    print(timeline.summary())
+    if args.timeline:
+        timeline.write(args.timeline)
+    print('%d calls' % len(modem.requests))
+
+
+class _Tun(object):
+    def __init__(self, fd):
+        self.fds = [fd]
+
+    def fileno(self):
+        return self.fds[0]
+
+
+async def _datapath(args):
+    host, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    # IPv4 UDP from 10.0.0.2 to 10.0.0.1, padded out to size
+    header = bytes.fromhex('450000000000000040110000'
+                           '0a0000020a00000103e807d0')
+    packet = header + bytes(args.size - len(header))
+    received = []
+
+    def receive():
+        for i in range(args.count):
+            received.append(host.recv(65536))
+
+    with fake_modem.MuxEchoPeer() as peer:
+        m = mux.XMMMux(peer.fd, tun_device=_Tun(b.fileno()))
+        await m.start()
+        receiver = threading.Thread(target=receive)
+        start = time.monotonic()
+        receiver.start()
+
+        def send():
+            for i in range(args.count):
+                host.send(packet)
+        await asyncio.get_running_loop().run_in_executor(None, send)
+        await asyncio.get_running_loop().run_in_executor(None, receiver.join)
+        elapsed = time.monotonic() - start
+        m.stop()
+
+    host.close()
+    b.close()
+    print('%d x %d bytes each way in %.3f s: %.0f packets/s, %.1f MB/s' % (
+        args.count, args.size, elapsed, args.count / elapsed,
+        args.count * args.size / elapsed / 1e6))
+    print('uplink frames %d, %.1f packets/frame' % (
+        m.stats['tx_frames'], m.stats['tx_packets'] / max(m.stats['tx_frames'], 1)))
+
+
+def datapath(args):
+    asyncio.run(_datapath(args))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('bringup', help="time each bring-up step")
+    p.add_argument('--latency', type=float, default=0.0,
+                   help="seconds before each response")
+    p.add_argument('--ip-delay', type=float, default=0.0,
+                   help="seconds from attach until an IP address is given")
+    p.add_argument('--attach-failures', type=int, default=0)
+    p.add_argument('--ip-fetch-timeout', type=float, default=1,
+                   help="retry interval for the IP address")
+    p.add_argument('--timeline', metavar='PATH',
+                   help="write a Chrome trace to PATH")
+    p.set_defaults(func=bringup)
+
+    p = sub.add_parser('datapath', help="echo packets through the mux")
+    p.add_argument('--count', type=int, default=100000)
+    p.add_argument('--size', type=int, default=1400)
+    p.set_defaults(func=datapath)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Compare building uplink mux frames in place in a pooled buffer against
+# the old approach of rebuilding a bytes object for every tag.
+
+import os
+import sys
+import struct
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rpc'))
+
+import mux  # noqa: E402
+
+
+class ConcatMuxPacket(object):
+    # MuxPacket as it was before frames were built in place
+    def __init__(self, seq=0):
+        self.seq = seq
+        self.packet = b''
+        self.fwd_pointer = None
+
+    def get_packet(self):
+        self.packet = self.packet[:8] + \
+            struct.pack('<L', len(self.packet)) + self.packet[8 + 4:]
+        return self.packet
+
+    def append_tag(self, tag, data=b'', extra=0):
+        hdr = tag
+
+        if self.packet == b'':
+            hdr += struct.pack('<HH', 0, self.seq)
+        else:
+            while len(self.packet) & 3:
+                self.packet += b'\0'
+            self.packet = self.packet[:self.fwd_pointer] + struct.pack(
+                '<L', len(self.packet)) + self.packet[self.fwd_pointer + 4:]
+
+        hdr_len = len(hdr) + 8
+        hdr += struct.pack('<HHL', hdr_len + len(data), extra, 0)
+        self.fwd_pointer = len(self.packet) + len(hdr) - 4
+
+        self.packet += hdr + data
+
+
+def concat_frame(packets, seq=1):
+    p = ConcatMuxPacket(seq=seq)
+    data = []
+    bounds = [struct.pack('<L', 0)]
+    offset = 16
+    for packet_data in packets:
+        packet_data = b'\0' * 16 + packet_data
+        data.append(packet_data)
+        bounds.append(struct.pack('<LL', offset, len(packet_data)))
+        offset += len(packet_data)
+    p.append_tag(b'ADBH', b''.join(data))
+    p.append_tag(b'ADTH', b''.join(bounds))
+    return p.get_packet()
+
+
+def new_mux():
+    # never started, so neither the mux node nor a TUN is opened
+    return mux.XMMMux()
+
+
+def inplace_frame(m, packets):
+    p = m.build_frame(packets)
+    frame = p.get_packet()
+    m.pool.put(p)
+    return frame
+
+
+def main(number=5000):
+    m = new_mux()
+    for count, size in [(1, 1400), (10, 1400), (64, 200)]:
+        packets = [bytes([0x45]) * size] * count
+        m.seq = 0
+        assert inplace_frame(m, packets) == concat_frame(packets)
+
+        old = min(timeit.repeat(lambda: concat_frame(packets),
+                                number=number, repeat=3)) / number
+        new = min(timeit.repeat(lambda: inplace_frame(m, packets),
+                                number=number, repeat=3)) / number
+        print('%2d x %4d bytes: concat %7.2f us, in place %7.2f us (%.1fx)' % (
+            count, size, old * 1e6, new * 1e6, old / new))
+
+
+if __name__ == "__main__":
+    main()
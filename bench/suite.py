@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+# Throughput of the RPC codecs and the mux framing, as ops/s and bytes/s,
+# plus the memory one operation allocates at its peak.
+#
+#   bench/suite.py                        print a table
+#   bench/suite.py --json out.json        also write the results
+#   bench/suite.py --baseline out.json    fail if anything got slower
+#
+# --baseline exits with status 1 when a case's ops/s drops more than
+# --tolerance below the baseline's, so CI can gate on it.
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import platform
+import tracemalloc
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rpc'))
+
+import rpc  # noqa: E402
+import mux  # noqa: E402
+
+
+def dns_response():
+    # what the modem sends for GetNegotiatedDns: 16 (address, type)
+    # slots, here two v4 and two v6 servers and the rest empty
+    args = [0]
+    servers = [(bytes([8, 8, 8, 8]), 1), (bytes([1, 1, 1, 1]), 1),
+               (bytes.fromhex('20014860486000000000000000008888'), 2),
+               (bytes.fromhex('26064700470000000000000000001111'), 2)]
+    for i in range(16):
+        address, typ = servers[i] if i < len(servers) else (b'', 0)
+        args += [address, typ]
+    args += [0, b'', 0, 0, 0, 0]
+    return rpc.pack('L' + 's20L' * 16 + 'Ls20LLLL', *args)
+
+
+def downlink_frames(count, size):
+    # one read's worth: several aggregated frames back to back
+    p = mux.MuxPacket()
+    p.append_datagrams([bytes([0x45]) * size] * count)
+    frame = bytes(p.get_packet())
+    return frame * (mux.MUX_READ_SIZE // len(frame))
+
+
+def consume(iterable):
+    collections.deque(iterable, 0)
+
+
+def cases():
+    apn = 'telstra.internet'
+    attach = rpc.pack_UtaMsCallPsAttachApnConfigReq(apn)
+    dns = dns_response()
+    # long strings, but each under 256 bytes: pack writes a multi-byte
+    # valid count big-endian and unpack reads it little-endian
+    blob = bytes(range(250))
+    big_fmt = rpc.compile_format('s260' * 4)
+    big_strings = big_fmt.pack(blob, blob, blob, blob)
+
+    yield 'rpc.pack attach config', len(attach), \
+        lambda: rpc._build_UtaMsCallPsAttachApnConfigReq(apn)
+    yield 'rpc.pack attach config (template)', len(attach), \
+        lambda: rpc.pack_UtaMsCallPsAttachApnConfigReq(apn)
+    yield 'rpc.unpack_unknown attach config', len(attach), \
+        lambda: rpc.unpack_unknown(attach)
+    yield 'rpc.unpack_unknown attach config (no copy)', len(attach), \
+        lambda: rpc.unpack_unknown(attach, copy=False)
+    yield 'rpc.unpack dns response', len(dns), \
+        lambda: rpc.unpack_UtaMsCallPsGetNegotiatedDnsReq(dns)
+    yield 'rpc.unpack_unknown dns response', len(dns), \
+        lambda: rpc.unpack_unknown(dns)
+    yield 'rpc.pack 4 x 250 byte strings', len(big_strings), \
+        lambda: big_fmt.pack(blob, blob, blob, blob)
+    yield 'rpc.unpack 4 x 250 byte strings', len(big_strings), \
+        lambda: rpc.unpack('ssss', big_strings)
+    yield 'rpc.unpack 4 x 250 byte strings (no copy)', len(big_strings), \
+        lambda: rpc.unpack('ssss', big_strings, copy=False)
+
+    m = mux.XMMMux()
+    for count, size in [(1, 1400), (10, 1400), (64, 200)]:
+        packets = [bytes([0x45]) * size] * count
+
+        def build(packets=packets):
+            m.pool.put(m.build_frame(packets))
+        yield 'mux build %d x %d' % (count, size), count * size, build
+
+    for count, size in [(10, 1400), (64, 200)]:
+        data = memoryview(downlink_frames(count, size))
+        stats = collections.Counter()
+        yield 'mux parse %d x %d' % (count, size), len(data), \
+            lambda data=data, stats=stats: consume(mux.parse_frames(data, stats))
+
+
+def peak_alloc(func):
+    func()      # warm any caches first
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        func()
+        return tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+
+
+def measure(func, min_time):
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    number = max(int(number * min_time / max(elapsed, 1e-9)), 1)
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+
+def run(match=None, min_time=0.2):
+    results = []
+    for name, nbytes, func in cases():
+        if match and match not in name:
+            continue
+        per_op = measure(func, min_time)
+        results.append({
+            'name': name,
+            'bytes': nbytes,
+            'ops_per_sec': 1 / per_op,
+            'bytes_per_sec': nbytes / per_op,
+            'peak_alloc': peak_alloc(func),
+        })
+    return results
+
+
+def compare(results, baseline, tolerance):
+    old = {r['name']: r for r in baseline['results']}
+    failed = []
+    for r in results:
+        if r['name'] not in old:
+            continue
+        ratio = r['ops_per_sec'] / old[r['name']]['ops_per_sec']
+        r['vs_baseline'] = ratio
+        if ratio < 1 - tolerance:
+            failed.append(r['name'])
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--match', help="only run cases containing this")
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help="seconds to time each repeat for")
+    parser.add_argument('--json', help="write results to this file")
+    parser.add_argument('--baseline', help="compare against this results file")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    results = run(args.match, args.min_time)
+    failed = []
+    if args.baseline:
+        with open(args.baseline) as fp:
+            failed = compare(results, json.load(fp), args.tolerance)
+
+    print('%-44s %12s %10s %10s' % ('', 'ops/s', 'MB/s', 'peak KiB'))
+    for r in results:
+        line = '%-44s %12.0f %10.1f %10.1f' % (
+            r['name'], r['ops_per_sec'], r['bytes_per_sec'] / 1e6,
+            r['peak_alloc'] / 1024)
+        if 'vs_baseline' in r:
+            line += ' %6.2fx' % r['vs_baseline']
+        print(line)
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump({'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'results': results}, fp, indent=2)
+
+    if failed:
+        print('slower than baseline: %s' % ', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import asyncio
+import collections
+
+import rpc
+
+
+class AsyncPendingCall(rpc.PendingCall):
+    def __init__(self, r, cmd, tid):
+        super().__init__(r, cmd, tid)
+        self.future = r.loop.create_future()
+
+    def set_response(self, resp):
+        super().set_response(resp)
+        if not self.future.done():
+            self.future.set_result(resp)
+
+    def result(self):
+        raise RuntimeError("use 'await call.future' on an AsyncXMMRPC")
+
+
+class AsyncXMMRPC(rpc.XMMRPC):
+    """XMMRPC driven by an asyncio event loop instead of blocking reads.
+
+    Must be created from a coroutine. The RPC node is read whenever the loop
+    sees it readable, so RPC, the data path and anything else can share one
+    loop.
+    """
+
+    call_class = AsyncPendingCall
+
+    def __init__(self, interfaces=['/dev/xmm0/rpc', '/dev/wwan0xmmrpc0'],
+                 timeout=None):
+        self.loop = asyncio.get_running_loop()
+        super().__init__(interfaces, timeout)
+        os.set_blocking(self.fp, False)
+
+        self.out_queue = collections.deque()
+        # futures from expect_unsolicited that are still waiting
+        self.waiters = set()
+        # UnsolicitedEvents still open
+        self.streams = set()
+        self.error = None
+
+        self.loop.add_reader(self.fp, self.on_readable)
+
+    def close(self):
+        self.shutdown(IOError("XMM RPC interface closed"))
+        os.close(self.fp)
+
+    def shutdown(self, exc):
+        # stop using the node, and fail everything waiting on it with exc
+        if self.error is None:
+            self.error = exc
+            self.loop.remove_reader(self.fp)
+            if self.out_queue:
+                self.loop.remove_writer(self.fp)
+                self.out_queue.clear()
+
+        for call in list(self.pending.values()) + list(self.pending_sync):
+            if not call.future.done():
+                call.future.set_exception(exc)
+        self.pending.clear()
+        self.pending_sync.clear()
+        for future in list(self.waiters):
+            if not future.done():
+                future.set_exception(exc)
+        for stream in list(self.streams):
+            stream.end()
+
+    def on_readable(self):
+        try:
+            self.reader.fill()
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # closed at the other end, or the device went away
+            self.shutdown(e)
+            return
+        message = self.reader.next_frame()
+        while message is not None:
+            self.process(message)
+            message = self.reader.next_frame()
+
+    def pump(self, is_async=False, have_ack=False, tid_word=None,
+             timeout=None, waiting_for='message'):
+        raise RuntimeError("AsyncXMMRPC is pumped by the event loop")
+
+    def submit(self, cmd, body=rpc.asn_int4(0), is_async=False):
+        # the node is gone, or fp may already belong to something else
+        if self.error is not None:
+            raise self.error
+        return super().submit(cmd, body, is_async)
+
+    def write(self, message):
+        if self.error is not None:
+            raise self.error
+        self.trace('tx', message)
+        if not self.out_queue:
+            try:
+                ret = os.write(self.fp, message)
+            except BlockingIOError:
+                ret = 0
+            except OSError as e:
+                # fails the call just registered along with the rest
+                self.shutdown(e)
+                return
+            if ret == len(message):
+                return
+            message = message[ret:]
+            self.loop.add_writer(self.fp, self.on_writable)
+        self.out_queue.append(message)
+
+    def on_writable(self):
+        while self.out_queue:
+            message = self.out_queue[0]
+            try:
+                ret = os.write(self.fp, message)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                self.shutdown(e)
+                return
+            if ret < len(message):
+                self.out_queue[0] = message[ret:]
+                return
+            self.out_queue.popleft()
+        self.loop.remove_writer(self.fp)
+
+    async def wait(self, future, timeout, waiting_for):
+        timeout = self.wait_time(rpc.make_deadline(timeout), waiting_for)
+        start = time.monotonic()
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            raise rpc.RPCTimeout(waiting_for) from None
+        if self.timeline is not None and waiting_for in rpc.unsol_codes:
+            self.timeline.span('wait', waiting_for, start)
+        return result
+
+    async def execute(self, cmd, body=rpc.asn_int4(0), is_async=False,
+                      timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        call = self.submit(cmd, body, is_async)
+        try:
+            return await self.wait(call.future, timeout, call.cmd)
+        except rpc.RPCTimeout:
+            self.abandon(call)
+            raise
+
+    async def execute_many(self, calls, timeout=None):
+        deadline = rpc.make_deadline(timeout)
+        return await asyncio.gather(*[self.execute(*call, timeout=deadline)
+                                      for call in calls])
+
+    def expect_unsolicited(self, name, predicate=None):
+        # Register interest now, so a message arriving before the caller
+        # gets round to awaiting it isn't missed.
+        future = self.loop.create_future()
+
+        def callback(message):
+            if not future.done() and (predicate is None or predicate(message)):
+                future.set_result(message)
+
+        def done(future):
+            self.waiters.discard(future)
+            self.unsolicited.unsubscribe(name, callback)
+
+        self.unsolicited.subscribe(name, callback)
+        self.waiters.add(future)
+        future.add_done_callback(done)
+        return future
+
+    async def wait_for_unsolicited(self, name, predicate=None, timeout=None):
+        future = self.expect_unsolicited(name, predicate)
+        try:
+            return await self.wait(future, timeout, name)
+        finally:
+            future.cancel()
+
+    def events(self, name=None):
+        return UnsolicitedEvents(self, name)
+
+
+class UnsolicitedEvents(object):
+    # Async iterator of (name, message) for the unsolicited messages with
+    # the given name, or all of them, received after it was created.
+
+    def __init__(self, r, name=None):
+        self.rpc = r
+        self.name = name
+        self.queue = asyncio.Queue()
+        r.unsolicited.subscribe(name, self.queue.put_nowait)
+        r.streams.add(self)
+        if r.error is not None:
+            self.end()
+
+    def close(self):
+        self.end()
+        self.queue = None
+
+    def end(self):
+        # finish iterating once the messages already queued are taken
+        if self in self.rpc.streams:
+            self.rpc.unsolicited.unsubscribe(self.name, self.queue.put_nowait)
+            self.rpc.streams.discard(self)
+            self.queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.queue is None:
+            raise StopAsyncIteration
+        message = await self.queue.get()
+        if message is None:
+            raise StopAsyncIteration
+        return rpc.unsol_name(message.code), message
+
+
+async def get_ip_config(r, timeout=None):
+    ip, dns = await r.execute_many(rpc.ip_config_calls, timeout)
+    return rpc.unpack_ip_config(ip.body, dns.body)
+
+
+async def UtaModeSet(r, mode, timeout=None):
+    mode_tid = 15
+    deadline = rpc.make_deadline(timeout)
+    done = r.expect_unsolicited('UtaModeSetRspCb')
+    try:
+        resp = await r.execute('UtaModeSetReq',
+                               rpc.pack('LLL', 0, mode_tid, mode),
+                               timeout=deadline)
+        if resp.content[0] != 0:
+            raise IOError("UtaModeSet failed. Bad value?")
+
+        msg = await r.wait(done, deadline, 'UtaModeSetRspCb')
+    finally:
+        done.cancel()
+    if msg.content[0] != mode:
+        raise IOError("UtaModeSet was not able to set mode. FCC lock enabled?")
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+# A stand-in for the modem, for running bring-up and the data path on a
+# machine without one.
+#
+# FakeModem answers RPC on a pty, which XMMRPC opens like the real node:
+#
+#   with fake_modem.FakeModem(latency=0.05) as modem:
+#       r = rpc.XMMRPC(interfaces=[modem.path])
+#
+# Responses, per-call latencies and unsolicited messages are scripted, so
+# slow firmware can be reproduced. MuxEchoPeer is the other end of a mux
+# node, handing each uplink datagram back down.
+
+import os
+import tty
+import socket
+import time
+import heapq
+import select
+import struct
+import itertools
+import threading
+import ipaddress
+import collections
+
+import rpc
+import rpc_call_ids
+import mux
+
+call_names = {v: k for k, v in rpc_call_ids.call_ids.items()}
+
+# An unsolicited message sent `after` seconds from the response to
+# `trigger`, or from start() if there is none.
+Event = collections.namedtuple('Event', 'after name body trigger')
+Event.__new__.__defaults__ = (rpc.asn_int4(0), None)
+
+
+def unsolicited_message(code, body, txid=0):
+    length = len(body) + 16
+    return struct.pack('<L', length) + rpc.asn_int4(length) + \
+        rpc.asn_int4(code) + struct.pack('>L', txid) + body
+
+
+def pack_ip_response(addresses):
+    # three IPv4 addresses, as GetNegIpAddr answers
+    data = b''.join(a.packed for a in addresses)
+    return rpc.pack('Ls12LLLL', 0, data, 0, 0, 0, 0)
+
+
+def pack_dns_response(servers):
+    # 16 slots of (address, type), type 1 for IPv4 and 2 for IPv6
+    args = [0]
+    for i in range(16):
+        if i < len(servers):
+            address = servers[i].packed
+            args += [address, 1 if len(address) == 4 else 2]
+        else:
+            args += [b'', 0]
+    args += [0, b'', 0, 0, 0, 0]
+    return rpc.pack('L' + 's20L' * 16 + 'Ls20LLLL', *args)
+
+
+class FakeModem(object):
+    """RPC responder on a pty, run in a thread between start() and stop().
+
+    responses maps call names to a response body, or to a function of the
+    request body returning one; calls not listed get asn_int4(0). latency
+    is the delay before each response, in seconds, or a dict of them by
+    call name. events is a list of Event to send unsolicited.
+
+    attach_failures makes that many UtaMsNetAttachReq calls fail, each
+    followed by UtaMsNetIsAttachAllowedIndCb, and ip_delay is how long
+    after attaching GetNegIpAddr starts returning an address. The
+    ip_indication message is sent at that point, unless it is None.
+    """
+
+    def __init__(self, responses=None, latency=0.0, events=(),
+                 attach_failures=0, ip_delay=0.0,
+                 ip_indication='UtaMsCallPsActivateStatusIndCb',
+                 ip_address=ipaddress.ip_address('10.0.0.2'),
+                 dns=(ipaddress.ip_address('10.0.0.1'),)):
+        self.responses = {
+            'CsiFccLockQueryReq': rpc.pack('LLL', 0, 1, 1),
+            'UtaModeSetReq': self.mode_set,
+            'UtaMsNetAttachReq': self.net_attach,
+            'UtaMsCallPsGetNegIpAddrReq': self.neg_ip_addr,
+            'UtaMsCallPsGetNegotiatedDnsReq': pack_dns_response(list(dns)),
+            'UtaMsCallPsConnectReq': rpc.pack('LLLL', 0, 0, 0, 0),
+            'UtaSysGetInfo': rpc.pack('LLs16', 0, 0, b'fake modem'),
+        }
+        if responses:
+            self.responses.update(responses)
+        self.latency = latency
+        self.events = list(events)
+        self.attach_failures = attach_failures
+        self.ip_delay = ip_delay
+        self.ip_indication = ip_indication
+        self.ip_address = ip_address
+        self.attached_at = None
+        self.followups = []
+
+        # (time received, call name) for every request
+        self.requests = []
+        self.outgoing = []
+        self.seq = itertools.count()
+        self.buf = b''
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.wake_r, self.wake_w = os.pipe()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self.running = True
+        now = time.monotonic()
+        for event in self.events:
+            if event.trigger is None:
+                self.send_event(event, now)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        os.write(self.wake_w, b'x')
+        self.thread.join()
+        for fd in (self.master, self.slave, self.wake_r, self.wake_w):
+            os.close(fd)
+
+    def send(self, data, at):
+        with self.lock:
+            heapq.heappush(self.outgoing, (at, next(self.seq), data))
+        os.write(self.wake_w, b'x')
+
+    def send_event(self, event, now):
+        self.send(unsolicited_message(rpc.unsol_codes[event.name], event.body),
+                  now + event.after)
+
+    def run(self):
+        while self.running:
+            with self.lock:
+                due = self.outgoing[0][0] if self.outgoing else None
+            timeout = None if due is None else max(due - time.monotonic(), 0)
+            readable, _, _ = select.select([self.master, self.wake_r], [], [],
+                                           timeout)
+            if self.wake_r in readable:
+                os.read(self.wake_r, 4096)
+            if self.master in readable:
+                self.buf += os.read(self.master, 65536)
+                self.handle_requests()
+
+            now = time.monotonic()
+            with self.lock:
+                ready = []
+                while self.outgoing and self.outgoing[0][0] <= now:
+                    ready.append(heapq.heappop(self.outgoing)[2])
+            for data in ready:
+                os.write(self.master, data)
+
+    def handle_requests(self):
+        while len(self.buf) >= 4:
+            length = struct.unpack_from('<L', self.buf)[0] + 4
+            if len(self.buf) < length:
+                return
+            frame, self.buf = self.buf[:length], self.buf[length:]
+            _, code = rpc.unpack('nn', frame[4:16])
+            tid_word = struct.unpack_from('>L', frame, 16)[0]
+            body = frame[20:]
+            if tid_word != 0x11000100:
+                body = body[6:]
+            self.handle_call(code, tid_word, body)
+
+    def handle_call(self, code, tid_word, body):
+        now = time.monotonic()
+        name = call_names.get(code, code)
+        self.requests.append((now, name))
+
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(name, 0.0)
+        # unsolicited messages that follow the response
+        self.followups = []
+
+        response = self.responses.get(name, rpc.asn_int4(0))
+        if callable(response):
+            response = response(body)
+
+        if tid_word == 0x11000100:
+            self.send(rpc.build_message(code, response), now + latency)
+        else:
+            self.send(rpc.build_message(2000 + code, rpc.asn_int4(0), tid_word),
+                      now)
+            self.send(rpc.build_message(code, response, tid_word),
+                      now + latency)
+        for data in self.followups:
+            self.send(data, now + latency)
+
+        for event in self.events:
+            if event.trigger == name:
+                self.send_event(event, now + latency)
+
+    def mode_set(self, body):
+        _, mode_tid, mode = rpc.unpack('nnn', body)
+        self.followups.append(unsolicited_message(
+            rpc.unsol_codes['UtaModeSetRspCb'], rpc.asn_int4(mode), mode_tid))
+        return rpc.asn_int4(0)
+
+    def net_attach(self, body):
+        if self.attach_failures:
+            self.attach_failures -= 1
+            code = rpc.unsol_codes['UtaMsNetIsAttachAllowedIndCb']
+            self.followups.append(
+                unsolicited_message(code, rpc.pack('LLL', 0, 0, 1)))
+            return rpc.pack('LL', 0, 0xffffffff)
+        self.attached_at = time.monotonic()
+        if self.ip_indication is not None:
+            self.send(unsolicited_message(rpc.unsol_codes[self.ip_indication],
+                                          rpc.asn_int4(0)),
+                      self.attached_at + self.ip_delay)
+        return rpc.pack('LL', 0, 0)
+
+    def neg_ip_addr(self, body):
+        zero = ipaddress.IPv4Address(0)
+        if self.attached_at is None or \
+                time.monotonic() < self.attached_at + self.ip_delay:
+            return pack_ip_response([zero, zero, zero])
+        return pack_ip_response([self.ip_address, zero, zero])
+
+
+def reflect(packet):
+    # swap an IPv4 packet's addresses, and its UDP ports, so it comes back
+    # as a reply; neither changes a checksum
+    packet = bytearray(packet)
+    if packet and packet[0] >> 4 == 4:
+        packet[12:16], packet[16:20] = packet[16:20], packet[12:16]
+        ihl = (packet[0] & 0xf) * 4
+        if packet[9] == 17 and len(packet) >= ihl + 4:
+            packet[ihl:ihl + 2], packet[ihl + 2:ihl + 4] = \
+                packet[ihl + 2:ihl + 4], packet[ihl:ihl + 2]
+    return bytes(packet)
+
+
+def downlink_frame(packets, seq=0):
+    # as the modem sends them: bounds point at the packets themselves
+    data = []
+    bounds = [0]
+    offset = 16
+    for packet in packets:
+        data.append(packet)
+        bounds += [offset, len(packet)]
+        offset += len(packet)
+    p = mux.MuxPacket(seq)
+    p.append_tag(b'ADBH', b''.join(data))
+    p.append_tag(b'ADTH', struct.pack('<%dL' % len(bounds), *bounds))
+    return bytes(p.get_packet())
+
+
+class MuxEchoPeer(object):
+    """The modem's end of a mux node, as a SOCK_SEQPACKET pair.
+
+    Give fd to XMMMux as its path. Each uplink frame's datagrams are
+    counted and, with reflect set, sent back down in one frame with their
+    IPv4 addresses swapped.
+    """
+
+    def __init__(self, reflect=True):
+        self.sock, self.mux_sock = socket.socketpair(socket.AF_UNIX,
+                                                     socket.SOCK_SEQPACKET)
+        self.fd = self.mux_sock.fileno()
+        self.reflect = reflect
+        self.stats = collections.Counter()
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # wakes the thread with an empty read
+        self.mux_sock.close()
+        self.thread.join()
+        self.sock.close()
+
+    def run(self):
+        buf = memoryview(bytearray(mux.MUX_READ_SIZE))
+        while True:
+            n = self.sock.recv_into(buf)
+            if n == 0:
+                return
+            packets = [bytes(d[16:]) for d in
+                       mux.parse_frames(buf[:n], self.stats)]
+            if packets and self.reflect:
+                self.sock.send(downlink_frame(map(reflect, packets)))
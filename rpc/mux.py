@@ -3,107 +3,420 @@
 import os
 import binascii
 import struct
-import pytap2
-import selectors
+import functools
+import asyncio
+import collections
+
+import tun
+
+# same limits as the kernel driver's mux: at most 64 datagrams in a frame,
+# which must fit in one TD page, and a queue flushed within 100us
+MUX_MAX_PACKETS = 64
+MUX_MAX_FRAME = 16384
+MUX_FLUSH_DEADLINE = 0.0001
+# a read returns at most one TD, but offer room for several so nothing is
+# ever truncated
+MUX_READ_SIZE = 4 * MUX_MAX_FRAME
+# frames waiting for the modem before the TUN stops being read
+MUX_MAX_QUEUED = 8
+
+
+_first_header = struct.Struct('<4sHHHHL')
+_next_header = struct.Struct('<4sHHL')
+_u32 = struct.Struct('<L')
+_zeros = bytes(16)
+_zero_frame = memoryview(bytes(MUX_MAX_FRAME))
+
+
+@functools.lru_cache(maxsize=None)
+def _bounds_table(n):
+    # the ADTH's unknown word followed by n (offset, length) pairs
+    return struct.Struct('<%dL' % (1 + 2 * n))
 
 
 class MuxPacket(object):
+    # Builds a frame in place in a preallocated buffer. get_packet() returns
+    # a view of that buffer, which is only valid until the packet is reset.
+
     def __init__(self, seq=0):
+        self.buf = bytearray(MUX_MAX_FRAME)
+        self.view = memoryview(self.buf)
+        self.reset(seq)
+
+    def reset(self, seq=0):
         self.seq = seq
-        self.packet = b''
+        self.length = 0
         self.fwd_pointer = None
 
+    def _reserve(self, n):
+        if self.length + n > len(self.buf):
+            raise ValueError("mux frame full")
+
     def get_packet(self):
         # put the final length in
-        self.packet = self.packet[:8] + \
-            struct.pack('<L', len(self.packet)) + self.packet[8 + 4:]
-        return self.packet
+        _u32.pack_into(self.buf, 8, self.length)
+        return self.view[:self.length]
 
     def append_tag(self, tag, data=b'', extra=0):
-        hdr = tag
-
-        if self.packet == b'':  # first tag gets a sequence number
-            hdr += struct.pack('<HH', 0, self.seq)
+        if self.length == 0:  # first tag gets a sequence number
+            header = _first_header
+            self._reserve(header.size + len(data))
+            header.pack_into(self.buf, 0, tag, 0, self.seq,
+                             header.size + len(data), extra, 0)
         else:
-            while len(self.packet) & 3:
-                self.packet += b'\0'
-            self.packet = self.packet[:self.fwd_pointer] + struct.pack(
-                '<L', len(self.packet)) + self.packet[self.fwd_pointer + 4:]
+            pad = -self.length & 3
+            header = _next_header
+            self._reserve(pad + header.size + len(data))
+            self.buf[self.length:self.length + pad] = _zeros[:pad]
+            self.length += pad
+            _u32.pack_into(self.buf, self.fwd_pointer, self.length)
+            header.pack_into(self.buf, self.length, tag,
+                             header.size + len(data), extra, 0)
+
+        # the next-tag pointer ends the header
+        self.fwd_pointer = self.length + header.size - 4
+        self.length += header.size
+        self.view[self.length:self.length + len(data)] = data
+        self.length += len(data)
+
+    def append_datagrams(self, packets):
+        # The whole data frame in one pass: an ADBH holding each packet
+        # after 16 bytes of padding, then an ADTH with the bounds table.
+        assert self.length == 0
+        n = len(packets)
+        n_bytes = sum(map(len, packets))
+        adth = (16 + 16 * n + n_bytes + 3) & ~3
+        self._reserve(adth + 16 + 8 * n)
+
+        buf = self.buf
+        view = self.view
+        # clear the padding in one go, then drop the packets in
+        view[16:adth] = _zero_frame[:adth - 16]
+        bounds = [0]
+        append = bounds.append
+        offset = 16
+        for packet in packets:
+            start = offset + 16
+            end = start + len(packet)
+            view[start:end] = packet
+            append(offset)
+            append(end - offset)
+            offset = end
+
+        _first_header.pack_into(buf, 0, b'ADBH', 0, self.seq, adth, 0, adth)
+        _next_header.pack_into(buf, adth, b'ADTH', 16 + 8 * n, 0, 0)
+        _bounds_table(n).pack_into(buf, adth + 12, *bounds)
+        self.length = adth + 16 + 8 * n
+        self.fwd_pointer = adth + 8
+
+
+class MuxPacketPool(object):
+    def __init__(self, count=4):
+        self.free = [MuxPacket() for i in range(count)]
+
+    def get(self, seq=0):
+        p = self.free.pop() if self.free else MuxPacket()
+        p.reset(seq)
+        return p
+
+    def put(self, p):
+        self.free.append(p)
+
+
+def frame_size(n_packets, n_bytes):
+    # ADBH header, 16 bytes of padding before each datagram, then the
+    # 4-aligned ADTH with its bounds table
+    size = 16 + n_bytes + 16 * n_packets
+    size = (size + 3) & ~3
+    return size + 16 + 8 * n_packets
+
+
+_frame_info = struct.Struct('<LL')       # length, first tag
+_tag_info = struct.Struct('<4sHHL')     # tag, length, extra, next tag
+_bound = struct.Struct('<LL')           # offset, length
+
+
+def parse_frames(view, stats):
+    # Yields a view of each downlink datagram in view, which may hold
+    # several frames back to back. Broken frames and bounds are counted in
+    # stats and skipped.
+    pos = 0
+    end = len(view)
+    while end - pos >= 16:
+        tag = view[pos:pos + 4]
+        length, next_tag = _frame_info.unpack_from(view, pos + 8)
+        if length < 16 or length > end - pos:
+            stats['rx_bad_frames'] += 1
+            return
+        if tag != b'ADBH':
+            # ACBH and friends: command replies, nothing for the TUN
+            stats['rx_other_frames'] += 1
+            pos += length
+            continue
+        stats['rx_frames'] += 1
 
-        hdr_len = len(hdr) + 8
-        hdr += struct.pack('<HHL', hdr_len + len(data), extra, 0)
-        # that last field is the next-tag pointer
-        self.fwd_pointer = len(self.packet) + len(hdr) - 4
+        seen = 16
+        while next_tag:
+            if next_tag < seen or next_tag + 12 > length:
+                stats['rx_bad_tags'] += 1
+                break
+            tag, tag_len, extra, following = _tag_info.unpack_from(
+                view, pos + next_tag)
+            if tag == b'ADTH':
+                if tag_len < 16 or next_tag + tag_len > length:
+                    stats['rx_bad_tags'] += 1
+                    break
+                for i in range(next_tag + 16, next_tag + tag_len - 7, 8):
+                    offset, dlen = _bound.unpack_from(view, pos + i)
+                    if dlen == 0:
+                        continue
+                    if offset < 16 or offset + dlen > length:
+                        stats['rx_bad_bounds'] += 1
+                        continue
+                    stats['rx_packets'] += 1
+                    stats['rx_bytes'] += dlen
+                    yield view[pos + offset:pos + offset + dlen]
+            seen = next_tag + 12
+            next_tag = following
 
-        self.packet += hdr + data
+        pos += length
 
 
 class XMMMux(object):
-    def package(self, packet_data):
-        self.seq = (self.seq + 1) & 0xff
-        p = MuxPacket(seq=self.seq)
-        packet_data = b'\0' * 16 + packet_data
-        p.append_tag(b'ADBH', packet_data)
-        p.append_tag(b'ADTH', struct.pack('<LLL', 0, 0x10, len(packet_data)))
-        # p.append_tag(b'QLTH', b'\0'*12)
-        pkt = p.get_packet()
-        return pkt
+    """The userspace data path: IP packets between a TUN interface and the
+    modem's mux node.
 
-    def __init__(self, path='/dev/xmm0/mux'):
-        self.fp = os.open(path, os.O_RDWR | os.O_SYNC)
+    Runs on an asyncio loop between start() and stop(). Frames the modem
+    won't take yet wait in a queue of at most max_queued frames; once that
+    fills the TUN queues stop being read, so the backlog builds up in the
+    kernel instead of here. Likewise a TUN that won't take downlink
+    packets stops the mux node being read.
 
-        self.seq = 0
+    path may also be an open fd, and tun_device an interface to use in
+    place of a new TunDevice; the caller keeps ownership of either.
+    """
 
-        pkd = binascii.unhexlify('414442480000010088000000700000006000000000383AFFFE800000000000000000000000000001FE80000000000000D438C1FD077C00C38600248840005550000000000000000005010000000005DC03044040FFFFFFFFFFFFFFFF0000000020018004142021F50000000000000000414454481800000000000000000000001000000060000000')
-        p = MuxPacket(seq=1)
-        p.append_tag(b'ADBH', binascii.unhexlify(
-            '6000000000383AFFFE800000000000000000000000000001FE80000000000000D438C1FD077C00C38600248840005550000000000000000005010000000005DC03044040FFFFFFFFFFFFFFFF0000000020018004142021F50000000000000000'))
-        p.append_tag(b'ADTH', struct.pack('<LLL', 0, 0x10, 0x60))
+    def __init__(self, path='/dev/xmm0/mux', queues=1,
+                 max_queued=MUX_MAX_QUEUED, tun_device=None):
+        self.path = path
+        self.queues = queues
+        self.max_queued = max_queued
+        self.fp = None
+        self.tun = tun_device
+        self.own_tun = tun_device is None
+        self.loop = None
 
-        print(binascii.hexlify(p.get_packet()))
-        print(binascii.hexlify(pkd))
+        self.seq = 0
+        self.pool = MuxPacketPool()
+        self.queue = []
+        self.queued_bytes = 0
+        self.flush_handle = None
+        self.stats = collections.Counter()
+        self.rx_buf = bytearray(MUX_READ_SIZE)
+        self.rx_view = memoryview(self.rx_buf)
 
-        assert pkd == p.get_packet()
+        # frames written in part or not at all, as (packet, bytes written)
+        self.tx_frames = collections.deque()
+        self.tx_backlog = 0
+        # downlink packets the TUN queue had no room for
+        self.tun_out = collections.deque()
+        self.tun_readers = False
+        self.stopped = None
 
-        self.tun = pytap2.TapDevice(pytap2.TapMode.Tun)
-        self.tun.up()
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = self.loop.create_future()
+        if isinstance(self.path, int):
+            self.fp = self.path
+            os.set_blocking(self.fp, False)
+        else:
+            self.fp = os.open(self.path,
+                              os.O_RDWR | os.O_SYNC | os.O_NONBLOCK)
+        if self.own_tun:
+            self.tun = tun.TunDevice(queues=self.queues)
+            self.tun.up()
+        for fd in self.tun.fds:
+            os.set_blocking(fd, False)
 
-        sel = selectors.DefaultSelector()
-        sel.register(self.fp, selectors.EVENT_READ, self.read_mux)
-        sel.register(self.tun, selectors.EVENT_READ, self.read_tun)
+        self.loop.add_reader(self.fp, self.read_mux)
+        self.resume_tun()
 
-        p = MuxPacket()
+        # open the data channel
+        p = self.pool.get()
         p.append_tag(b'ACBH')
         p.append_tag(b'CMDH', struct.pack('<LLLL', 1, 0, 0, 0))
-        os.write(self.fp, p.get_packet())
+        self.send(p)
+
+    def stop(self):
+        if self.fp is None:
+            return
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.pause_tun()
+        self.loop.remove_reader(self.fp)
+        self.loop.remove_writer(self.fp)
+        if self.tun_out:
+            self.loop.remove_writer(self.tun.fileno())
+        if self.own_tun:
+            self.tun.close()
+        if not isinstance(self.path, int):
+            os.close(self.fp)
+        self.fp = None
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+    async def run(self):
+        await self.start()
+        try:
+            await self.stopped
+        finally:
+            self.stop()
+
+    def package(self, packet_data):
+        return self.package_many([packet_data])
+
+    def package_many(self, packets):
+        p = self.build_frame(packets)
+        pkt = bytes(p.get_packet())
+        self.pool.put(p)
+        return pkt
 
-        while True:
-            events = sel.select()
-            for key, mask in events:
-                callback = key.data
-                callback()
+    def build_frame(self, packets):
+        # one ADBH holding every datagram, and an ADTH listing them; give
+        # the packet back to self.pool once it has been written
+        self.seq = (self.seq + 1) & 0xff
+        p = self.pool.get(seq=self.seq)
+        try:
+            p.append_datagrams(packets)
+        except ValueError:
+            self.pool.put(p)
+            raise
+        return p
+
+    def queue_packet(self, packet):
+        if frame_size(1, len(packet)) > MUX_MAX_FRAME:
+            # too big for a frame of its own, as the driver drops them
+            self.stats['tx_dropped'] += 1
+            return
+        if self.queue:
+            size = frame_size(len(self.queue) + 1,
+                              self.queued_bytes + len(packet))
+            if len(self.queue) >= MUX_MAX_PACKETS or size > MUX_MAX_FRAME:
+                self.flush()
+        self.queue.append(packet)
+        self.queued_bytes += len(packet)
+        if self.flush_handle is None:
+            self.flush_handle = self.loop.call_later(MUX_FLUSH_DEADLINE,
+                                                     self.flush)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.queue:
+            return
+        packets, self.queue = self.queue, []
+        queued_bytes, self.queued_bytes = self.queued_bytes, 0
+        p = self.build_frame(packets)
+        self.stats['tx_frames'] += 1
+        self.stats['tx_packets'] += len(packets)
+        self.stats['tx_bytes'] += queued_bytes
+        self.send(p)
+
+    def send(self, p):
+        if not self.tx_frames:
+            written = self.write_frame(p, 0)
+            if written is None:
+                return
+            self.loop.add_writer(self.fp, self.on_mux_writable)
+        else:
+            written = 0
+        self.tx_frames.append((p, written))
+        self.tx_backlog += p.length - written
+        if len(self.tx_frames) >= self.max_queued:
+            self.stats['tx_stalls'] += 1
+            self.pause_tun()
+
+    def write_frame(self, p, written):
+        # None once the whole frame is out, else how much of it is
+        try:
+            written += os.write(self.fp, p.get_packet()[written:])
+        except BlockingIOError:
+            return written
+        if written < p.length:
+            return written
+        self.pool.put(p)
+        return None
 
-    def read_tun(self):
-        packet = self.tun.read()
-        os.write(self.fp, self.package(packet))
+    def on_mux_writable(self):
+        while self.tx_frames:
+            p, written = self.tx_frames[0]
+            now = self.write_frame(p, written)
+            if now is not None:
+                self.tx_frames[0] = (p, now)
+                self.tx_backlog -= now - written
+                return
+            self.tx_frames.popleft()
+            self.tx_backlog -= p.length - written
+            if len(self.tx_frames) <= self.max_queued // 2:
+                self.resume_tun()
+        self.loop.remove_writer(self.fp)
+
+    def pause_tun(self):
+        if self.tun_readers:
+            for fd in self.tun.fds:
+                self.loop.remove_reader(fd)
+            self.tun_readers = False
+
+    def resume_tun(self):
+        if not self.tun_readers:
+            for fd in self.tun.fds:
+                self.loop.add_reader(fd, self.read_tun, fd)
+            self.tun_readers = True
+
+    def read_tun(self, fd):
+        # take everything that is waiting; a full frame goes out at once,
+        # the rest when the flush deadline passes
+        for packet in tun.read_batch(fd, 4 * MUX_MAX_PACKETS):
+            self.queue_packet(packet)
 
     def read_mux(self):
-        data = os.read(self.fp, 8192)
-        if data.startswith(b'ADBH'):
-            unq, seq, length, sublen = struct.unpack('<HHLL', data[4:16])
+        try:
+            n = os.readv(self.fp, [self.rx_buf])
+        except BlockingIOError:
+            return
+        datagrams = list(parse_frames(self.rx_view[:n], self.stats))
+        sent = tun.write_batch(self.tun.fileno(), datagrams)
+        if sent < len(datagrams):
+            # the read buffer is about to be reused, so these get copied
+            self.tun_out.extend(bytes(d) for d in datagrams[sent:])
+            self.stats['rx_stalls'] += 1
+            self.loop.remove_reader(self.fp)
+            self.loop.add_writer(self.tun.fileno(), self.on_tun_writable)
+
+    def on_tun_writable(self):
+        sent = tun.write_batch(self.tun.fileno(), self.tun_out)
+        for i in range(sent):
+            self.tun_out.popleft()
+        if not self.tun_out:
+            self.loop.remove_writer(self.tun.fileno())
+            self.loop.add_reader(self.fp, self.read_mux)
+
+
+def self_test():
+    pkd = binascii.unhexlify('414442480000010088000000700000006000000000383AFFFE800000000000000000000000000001FE80000000000000D438C1FD077C00C38600248840005550000000000000000005010000000005DC03044040FFFFFFFFFFFFFFFF0000000020018004142021F50000000000000000414454481800000000000000000000001000000060000000')
+    p = MuxPacket(seq=1)
+    p.append_tag(b'ADBH', binascii.unhexlify(
+        '6000000000383AFFFE800000000000000000000000000001FE80000000000000D438C1FD077C00C38600248840005550000000000000000005010000000005DC03044040FFFFFFFFFFFFFFFF0000000020018004142021F50000000000000000'))
+    p.append_tag(b'ADTH', struct.pack('<LLL', 0, 0x10, 0x60))
 
-            tail = data[sublen:]
+    print(binascii.hexlify(p.get_packet()))
+    print(binascii.hexlify(pkd))
 
-            if tail.startswith(b'ADTH'):
-                length, unk = struct.unpack('<HH', tail[4:8])
-                tail = tail[16:]
-                while len(tail) >= 8:
-                    offset, length = struct.unpack('<LL', tail[:8])
-                    puk = data[offset:offset + length]
-                    # print('ai>', binascii.hexlify(puk))
-                    self.tun.write(puk)
-                    tail = tail[8:]
+    assert pkd == p.get_packet()
 
 
 if __name__ == "__main__":
-    mux = XMMMux()
+    self_test()
+    asyncio.run(XMMMux().run())
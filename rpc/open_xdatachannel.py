@@ -8,9 +8,10 @@ import socket
 import struct
 import dbus
 import sys
-import time
 
 import rpc
+import rpc_capture
+import rpc_timeline
 import logging
 # must do this before importing pyroute2
 logging.basicConfig(level=logging.DEBUG)
@@ -31,101 +32,104 @@ parser.add_argument('-n', '--nodefaultroute', action="store_true",
 parser.add_argument('-m', '--metric', type=int, default=1000,
                     help="Metric for default route (higher is lower priority)")
 parser.add_argument('-t', '--ip-fetch-timeout', type=int, default=1,
-                    help="Retry interval in seconds when getting IP config")
+                    help="Longest wait in seconds between polls for the IP config")
 parser.add_argument('-r', '--noresolv', action="store_true",
                     help="Don't add modem-provided DNS servers to /etc/resolv.conf")
 parser.add_argument('-d', '--dbus', action="store_true",
                     help="Activate Networkmanager Connection via DBUS")
+parser.add_argument('--rpc-timeout', type=float, default=30,
+                    help="Seconds to wait for each firmware RPC response")
+parser.add_argument('--bringup-timeout', type=float, default=0,
+                    help="Seconds allowed for the whole bring-up, 0 (the default) for no limit")
+parser.add_argument('--rpc-log-level', default='INFO',
+                    choices=['TRACE', 'DEBUG', 'INFO', 'WARNING'],
+                    help="Log level for RPC traffic (TRACE adds hex dumps)")
+parser.add_argument('--rpc-capture', metavar='PATH',
+                    help="Record raw RPC frames to PATH for rpc_capture.py")
+parser.add_argument('--timeline', metavar='PATH',
+                    help="Write a Chrome trace of the bring-up to PATH")
 
 cfg, unknown = parser.parse_known_args()
 
+logging.getLogger('xmm7360.rpc').setLevel(cfg.rpc_log_level)
+
+timeline = rpc_timeline.Timeline()
+
 r = None
 try:
-    r = rpc.XMMRPC()
+    r = rpc.XMMRPC(timeout=cfg.rpc_timeout)
 except Exception as ex:
     logging.error(ex)
     exit()
 
-ipr = IPRoute()
-
-r.execute('UtaMsSmsInit')
-r.execute('UtaMsCbsInit')
-r.execute('UtaMsNetOpen')
-r.execute('UtaMsCallCsInit')
-r.execute('UtaMsCallPsInitialize')
-r.execute('UtaMsSsInit')
-r.execute('UtaMsSimOpenReq')
-
-rpc.do_fcc_unlock(r)
-# disable aeroplane mode if had been FCC-locked. first and second args are probably don't-cares
-rpc.UtaModeSet(r, 1)
-
-r.execute('UtaMsCallPsAttachApnConfigReq',
-          rpc.pack_UtaMsCallPsAttachApnConfigReq(cfg.apn), is_async=True)
+if cfg.bringup_timeout:
+    r.set_deadline(cfg.bringup_timeout)
+if cfg.rpc_capture:
+    r.capture = rpc_capture.FrameCapture(cfg.rpc_capture)
+r.timeline = timeline
 
-attach = r.execute('UtaMsNetAttachReq',
-                   rpc.pack_UtaMsNetAttachReq(), is_async=True)
-_, status = rpc.unpack('nn', attach['body'])
-
-if status == 0xffffffff:
-    logging.info("Attach failed - waiting to see if we just weren't ready")
-
-    while not r.attach_allowed:
-        r.pump()
-
-    attach = r.execute('UtaMsNetAttachReq',
-                       rpc.pack_UtaMsNetAttachReq(), is_async=True)
-    _, status = rpc.unpack('nn', attach['body'])
+ipr = IPRoute()
 
-    if status == 0xffffffff:
-        logging.error("Attach failed again, giving up")
+try:
+    with timeline.phase('init services'):
+        rpc.init_services(r)
+
+    with timeline.phase('fcc unlock'):
+        rpc.do_fcc_unlock(r)
+    with timeline.phase('mode set'):
+        # disable aeroplane mode if had been FCC-locked. first and second args are probably don't-cares
+        rpc.UtaModeSet(r, 1)
+
+    try:
+        with timeline.phase('attach'):
+            rpc.attach(r, cfg.apn)
+    except rpc.RPCTimeout:
+        raise
+    except IOError as e:
+        logging.error(e)
         sys.exit(1)
 
-while True:
-    ip_addr, dns_values = rpc.get_ip(r)
-    if ip_addr is not None:
-        break
-    interval = cfg.ip_fetch_timeout
-    logging.info(f"IP address couldn't be fetched, waiting {interval} seconds")
-    time.sleep(interval)
-
-logging.info("IP address: " + str(ip_addr))
-logging.info("DNS server(s): " + ', '.join(map(str, dns_values['v4'] + dns_values['v6'])))
-
-idx = ipr.link_lookup(ifname='wwan0')[0]
-
-ipr.flush_addr(index=idx)
-ipr.link('set',
-         index=idx,
-         state='up')
-ipr.addr('add',
-         index=idx,
-         address=ip_addr)
-
-
-if not cfg.nodefaultroute:
-    ipr.route('add',
-              dst='default',
-              priority=cfg.metric,
-              oif=idx)
-
-# Add DNS values to /etc/resolv.conf
-if not cfg.noresolv:
-    with open('/etc/resolv.conf', 'a') as resolv:
-        resolv.write('\n# Added by xmm7360\n')
-        for dns in dns_values['v4'] + dns_values['v6']:
-            resolv.write('nameserver %s\n' % dns)
-
-# this gives us way too much stuff, which we need
-pscr = r.execute('UtaMsCallPsConnectReq',
-                 rpc.pack_UtaMsCallPsConnectReq(), is_async=True)
-# this gives us a handle we need
-dcr = r.execute('UtaRPCPsConnectToDatachannelReq',
-                rpc.pack_UtaRPCPsConnectToDatachannelReq())
-
-csr_req = pscr['body'][:-6] + dcr['body'] + b'\x02\x04\0\0\0\0'
-
-r.execute('UtaRPCPSConnectSetupReq', csr_req)
+    with timeline.phase('get ip'):
+        ip_addr, dns_values = rpc.wait_for_ip(r, cfg.ip_fetch_timeout)
+
+    logging.info("IP address: " + str(ip_addr))
+    logging.info("DNS server(s): " + ', '.join(map(str, dns_values['v4'] + dns_values['v6'])))
+
+    with timeline.phase('configure wwan0'):
+        idx = ipr.link_lookup(ifname='wwan0')[0]
+
+        ipr.flush_addr(index=idx)
+        ipr.link('set',
+                 index=idx,
+                 state='up')
+        ipr.addr('add',
+                 index=idx,
+                 address=ip_addr)
+
+        if not cfg.nodefaultroute:
+            ipr.route('add',
+                      dst='default',
+                      priority=cfg.metric,
+                      oif=idx)
+
+        # Add DNS values to /etc/resolv.conf
+        if not cfg.noresolv:
+            with open('/etc/resolv.conf', 'a') as resolv:
+                resolv.write('\n# Added by xmm7360\n')
+                for dns in dns_values['v4'] + dns_values['v6']:
+                    resolv.write('nameserver %s\n' % dns)
+
+    with timeline.phase('connect'):
+        rpc.connect_datachannel(r)
+except rpc.RPCTimeout as e:
+    logging.error("Bring-up failed: %s", e)
+    sys.exit(1)
+r.set_deadline(None)
+logging.debug("RPC latency:\n" + r.latency_summary())
+logging.debug("RPC traffic: %s" % dict(r.stats))
+logging.info("Bring-up timeline:\n" + timeline.summary())
+if cfg.timeline:
+    timeline.write(cfg.timeline)
 
 if not cfg.dbus:
     sys.exit(1)
@@ -1,21 +1,288 @@
 #!/usr/bin/env python3
 
 import os
+import time
+import random
+import select
 import binascii
 import struct
 import itertools
+import collections
+import functools
 import ipaddress
 import hashlib
+import logging
 import rpc_call_ids
 import rpc_unsol_table
 
+log = logging.getLogger('xmm7360.rpc')
+
+# below DEBUG: hex dumps of every frame
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+
+
+class Hex(object):
+    # formats as hex only if the log record is actually emitted
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return binascii.hexlify(self.data).decode('ascii')
+
 
 def asn_int4(val):
     return b'\x02\x04' + struct.pack('>L', val)
 
 
+def build_message(cmd, body, tid=0):
+    tid_word = 0x11000100 | tid
+
+    total_length = len(body) + 16
+    if tid:
+        total_length += 6
+    header = struct.pack('<L', total_length) + asn_int4(total_length) + \
+        asn_int4(cmd) + struct.pack('>L', tid_word)
+    if tid:
+        header += asn_int4(tid)
+
+    assert total_length + 4 == len(header) + len(body)
+    return header + body
+
+
+class RPCTimeout(TimeoutError):
+    def __init__(self, command):
+        super().__init__("timed out waiting for %s" % command)
+        self.command = command
+
+
+class Deadline(object):
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.expires = time.monotonic() + timeout
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+
+def make_deadline(timeout):
+    if timeout is None or isinstance(timeout, Deadline):
+        return timeout
+    return Deadline(timeout)
+
+
+class LatencyHistogram(object):
+    # bucket i counts calls that took less than 2**i ms; the last bucket
+    # takes everything slower
+    n_buckets = 16
+
+    def __init__(self):
+        self.buckets = [0] * self.n_buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        bucket = min(int(ms).bit_length(), self.n_buckets - 1)
+        self.buckets[bucket] += 1
+
+    def __str__(self):
+        hist = ' '.join('<%dms:%d' % (1 << i, n)
+                        for i, n in enumerate(self.buckets) if n)
+        return 'n=%d avg=%.1fms max=%.1fms %s' % (
+            self.count, self.total * 1000 / self.count, self.max * 1000, hist)
+
+
+unsol_codes = {name: code
+               for code, name in rpc_unsol_table.xmm7360_unsol.items()}
+
+
+@functools.lru_cache(maxsize=None)
+def unsol_name(code):
+    return rpc_unsol_table.xmm7360_unsol.get(code, '0x%02x' % code)
+
+
+# length, ASN.1 length, ASN.1 code and transaction id. The first length is
+# little-endian, but is read big-endian so the header is a single unpack.
+_message_header = struct.Struct('>L2sL2sLL')
+
+
+class Message(object):
+    """One received RPC message. The body is decoded on first access to
+    content, and only once."""
+
+    __slots__ = ('tid', 'type', 'code', 'body', '_content')
+
+    def __init__(self, tid, type, code, body):
+        self.tid = tid
+        self.type = type
+        self.code = code
+        self.body = body
+        self._content = None
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = unpack_unknown(self.body)
+        return self._content
+
+    def __getitem__(self, key):
+        # messages used to be dicts
+        return getattr(self, key)
+
+    def __repr__(self):
+        return '<Message %s 0x%x tid 0x%08x>' % (self.type, self.code, self.tid)
+
+
+class UnsolicitedDispatcher(object):
+    """Routes unsolicited messages to subscribers by code.
+
+    Messages nobody has subscribed to are dropped without their body ever
+    being decoded.
+    """
+
+    def __init__(self):
+        self.subscribers = {}
+        self.all = []
+
+    def _code(self, name):
+        if isinstance(name, int):
+            return name
+        try:
+            return unsol_codes[name]
+        except KeyError:
+            raise ValueError("unknown unsolicited message %s" % name)
+
+    def subscribe(self, name, callback):
+        # name is an unsolicited name or code, or None for every message
+        if name is None:
+            self.all.append(callback)
+        else:
+            self.subscribers.setdefault(self._code(name), []).append(callback)
+        return callback
+
+    def unsubscribe(self, name, callback):
+        if name is None:
+            self.all.remove(callback)
+            return
+        code = self._code(name)
+        callbacks = self.subscribers[code]
+        callbacks.remove(callback)
+        if not callbacks:
+            del self.subscribers[code]
+
+    def queue(self, name, maxlen=None):
+        # subscribe a deque that collects the matching messages
+        queue = collections.deque(maxlen=maxlen)
+        self.subscribe(name, queue.append)
+        return queue
+
+    def dispatch(self, message):
+        callbacks = self.subscribers.get(message.code)
+        if not callbacks and not self.all:
+            return
+        for callback in (callbacks or []) + self.all:
+            callback(message)
+
+
+class FrameReader(object):
+    """Splits the bytes read from the RPC node into messages.
+
+    Reads go into one reusable buffer. A read may hold several messages or
+    only part of one; complete messages are split off by their length
+    prefix and the rest is kept for the next read.
+    """
+
+    # the driver truncates a read that is shorter than the queued data, so
+    # always offer at least this much space
+    read_size = 131072
+    max_message = 1 << 20
+    _length = struct.Struct('<L')
+
+    def __init__(self, fd, stats):
+        self.fd = fd
+        self.stats = stats
+        self.buf = bytearray(2 * self.read_size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+    def fill(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buf) - self.end < self.read_size:
+            # move the partial message to the front
+            n = self.end - self.start
+            self.view[:n] = self.view[self.start:self.end]
+            self.start, self.end = 0, n
+            if len(self.buf) - n < self.read_size:
+                self.view.release()
+                self.buf.extend(bytes(self.read_size))
+                self.view = memoryview(self.buf)
+
+        n = os.readv(self.fd, [self.view[self.end:]])
+        if n == 0:
+            raise IOError("XMM RPC interface closed")
+        self.end += n
+        return n
+
+    def next_frame(self):
+        # the next complete message, or None if more must be read first
+        available = self.end - self.start
+        if available < 4:
+            return None
+        length = self._length.unpack_from(self.buf, self.start)[0] + 4
+        if length < 20 or length > self.max_message:
+            # nothing to resync on, so drop what we have
+            self.stats['framing_errors'] += 1
+            self.stats['framing_dropped_bytes'] += available
+            log.warning("bad message length %d, dropping %d bytes",
+                        length, available)
+            self.start = self.end = 0
+            return None
+        if available < length:
+            self.stats['partial_reads'] += 1
+            return None
+
+        frame = self.view[self.start:self.start + length].tobytes()
+        self.start += length
+        return frame
+
+
+class PendingCall(object):
+    def __init__(self, rpc, cmd, tid):
+        self.rpc = rpc
+        self.cmd = cmd
+        self.tid = tid
+        self.acked = False
+        self.response = None
+        self.sent = time.monotonic()
+
+    def set_response(self, resp):
+        self.response = resp
+
+    def done(self):
+        return self.response is not None
+
+    def result(self, timeout=None):
+        deadline = make_deadline(timeout)
+        while self.response is None:
+            self.rpc.pump(timeout=self.rpc.wait_time(deadline, self.cmd),
+                          waiting_for=self.cmd)
+        return self.response
+
+
 class XMMRPC(object):
-    def __init__(self, interfaces=['/dev/xmm0/rpc', '/dev/wwan0xmmrpc0']):
+    call_class = PendingCall
+
+    def __init__(self, interfaces=['/dev/xmm0/rpc', '/dev/wwan0xmmrpc0'],
+                 timeout=None):
         selected_interface = None
         for interface in interfaces:
             if os.path.exists(interface):
@@ -24,107 +291,229 @@ class XMMRPC(object):
         if selected_interface is None:
             raise IOError('XMM RPC interface does not exists')
 
+        # frames and bytes per direction, framing errors
+        self.stats = collections.Counter()
+
         self.fp = os.open(selected_interface, os.O_RDWR | os.O_SYNC)
+        self.reader = FrameReader(self.fp, self.stats)
+        self.poller = select.poll()
+        self.poller.register(self.fp, select.POLLIN)
+
+        # default per-call timeout, and an optional deadline for everything
+        self.timeout = timeout
+        self.deadline = None
+        # per-command response latency
+        self.latency = collections.defaultdict(LatencyHistogram)
+
+        self.unsolicited = UnsolicitedDispatcher()
+        self.unsolicited.subscribe('UtaMsNetIsAttachAllowedIndCb',
+                                   self.on_attach_allowed)
 
         # loop over 1..255, excluding 0
         self.tid_gen = itertools.cycle(range(1, 256))
+        # async calls in flight, keyed by their tid word
+        self.pending = {}
+        # sync calls all share tid 0 and are answered in order
+        self.pending_sync = collections.deque()
 
         self.attach_allowed = False
 
-    def pump(self, is_async=False, have_ack=False, tid_word=None):
-        message = os.read(self.fp, 131072)
+        # optional rpc_capture.FrameCapture for raw frames
+        self.capture = None
+        # optional rpc_timeline.Timeline of calls and waits
+        self.timeline = None
+
+    def trace(self, direction, message):
+        self.stats[direction + '_frames'] += 1
+        self.stats[direction + '_bytes'] += len(message)
+        if self.capture is not None:
+            self.capture.write(direction, message)
+        if log.isEnabledFor(TRACE):
+            log.log(TRACE, '%s %s', direction, Hex(message))
+
+    def set_deadline(self, timeout):
+        # limit every following call, e.g. to bound a whole bring-up
+        self.deadline = make_deadline(timeout)
+
+    def wait_time(self, deadline, waiting_for):
+        # how long we may block for, or None for forever
+        deadlines = [d for d in (deadline, self.deadline) if d is not None]
+        if not deadlines:
+            return None
+        remaining = min(d.remaining() for d in deadlines)
+        if remaining <= 0:
+            raise RPCTimeout(waiting_for)
+        return remaining
+
+    def pump(self, is_async=False, have_ack=False, tid_word=None,
+             timeout=None, waiting_for='message'):
+        deadline = make_deadline(timeout)
+        start = time.monotonic()
+        message = self.reader.next_frame()
+        while message is None:
+            if deadline is not None:
+                remaining = max(deadline.remaining(), 0)
+                if not self.poller.poll(int(remaining * 1000) + 1):
+                    raise RPCTimeout(waiting_for)
+            self.reader.fill()
+            message = self.reader.next_frame()
+        if self.timeline is not None and waiting_for in unsol_codes:
+            self.timeline.span('wait', waiting_for, start)
+        return self.process(message)
+
+    def process(self, message):
+        self.trace('rx', message)
         resp = self.handle_message(message)
 
-        desc = resp['type']
-
-        if resp['type'] == 'unsolicited':
-            name = rpc_unsol_table.xmm7360_unsol.get(
-                resp['code'], '0x%02x' % resp['code'])
-            desc = 'unsolicited: %s' % name
-            self.handle_unsolicited(resp)
+        if resp.type == 'unsolicited':
+            self.unsolicited.dispatch(resp)
+        else:
+            self.complete(resp)
 
-        print(desc + ':', format_unknown(resp['body']))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s: %s', describe_message(resp),
+                      format_content(resp.content))
         return resp
 
-    def execute(self, cmd, body=asn_int4(0), is_async=False):
-        print("RPC executing %s" % cmd)
+    def complete(self, resp):
+        tid = resp.tid
+        if resp.type == 'async_ack':
+            call = self.pending.get(tid)
+            if call is not None:
+                call.acked = True
+            return
+
+        if tid == 0x11000100:
+            call = self.pending_sync.popleft() if self.pending_sync else None
+        else:
+            call = self.pending.pop(tid, None)
+
+        if call is None:
+            log.warning("response for unknown transaction 0x%08x", tid)
+        else:
+            self.latency[call.cmd].add(time.monotonic() - call.sent)
+            if self.timeline is not None:
+                self.timeline.span('rpc', call.cmd, call.sent)
+            call.set_response(resp)
+
+    def abandon(self, call):
+        # Forget a timed out async call so its tid can be reused. Sync calls
+        # stay queued, as their late response must still be matched to them.
+        if self.pending.get(call.tid) is call:
+            del self.pending[call.tid]
+
+    def latency_summary(self):
+        return '\n'.join('%s: %s' % (cmd, hist)
+                         for cmd, hist in sorted(self.latency.items()))
+
+    def next_tid(self):
+        for i in range(255):
+            tid = 0x11000100 | next(self.tid_gen)
+            if tid not in self.pending:
+                return tid
+        raise IOError("no free RPC transaction IDs")
+
+    def submit(self, cmd, body=asn_int4(0), is_async=False):
+        log.debug("RPC submitting %s", cmd)
+        name = cmd
         if isinstance(cmd, str):
             cmd = rpc_call_ids.call_ids[cmd]
 
         if is_async:
-            tid = 0x11000101
+            tid = self.next_tid()
         else:
             tid = 0
 
-        tid_word = 0x11000100 | tid
+        message = build_message(cmd, body, tid)
 
-        total_length = len(body) + 16
+        call = self.call_class(self, name, 0x11000100 | tid)
         if tid:
-            total_length += 6
-        header = struct.pack('<L', total_length) + asn_int4(total_length) + \
-            asn_int4(cmd) + struct.pack('>L', tid_word)
-        if tid:
-            header += asn_int4(tid)
-
-        assert total_length + 4 == len(header) + len(body)
-
-        print(binascii.hexlify(header + body))
-        ret = os.write(self.fp, header + body)
-        if ret < len(header + body):
-            print("write error: %d", ret)
-
-        while True:
-            resp = self.pump()
-            if resp['type'] == 'response':
-                break
-
-        return resp
+            self.pending[call.tid] = call
+        else:
+            self.pending_sync.append(call)
+
+        self.write(message)
+        return call
+
+    def write(self, message):
+        self.trace('tx', message)
+        ret = os.write(self.fp, message)
+        if ret < len(message):
+            log.error("write error: %d", ret)
+
+    def execute(self, cmd, body=asn_int4(0), is_async=False, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        call = self.submit(cmd, body, is_async)
+        try:
+            return call.result(timeout)
+        except RPCTimeout:
+            self.abandon(call)
+            raise
+
+    def execute_many(self, calls, timeout=None):
+        # Send every (cmd, body, is_async) request before waiting for any
+        # response, then return the responses in order. The timeout covers
+        # the lot.
+        if timeout is None:
+            timeout = self.timeout
+        deadline = make_deadline(timeout)
+        pending = [self.submit(*call) for call in calls]
+        try:
+            return [call.result(deadline) for call in pending]
+        except RPCTimeout:
+            for call in pending:
+                self.abandon(call)
+            raise
 
     def handle_message(self, message):
-        length = message[:4]
-        len1_p = message[4:10]
-        code_p = message[10:16]
-        txid = message[16:20]
-        body = message[20:]
+        resp, length_ok = parse_message(message)
+        if not length_ok:
+            self.stats['length_mismatch'] += 1
+            log.warning("length mismatch, framing error?")
+        return resp
 
-        assert len1_p.startswith(b'\x02\x04')
-        assert code_p.startswith(b'\x02\x04')
+    def on_attach_allowed(self, message):
+        self.attach_allowed = message.content[2]
 
-        l0 = struct.unpack('<L', length)[0]
-        l1 = struct.unpack('>L', len1_p[2:])[0]
-        code = struct.unpack('>L', code_p[2:])[0]
-        txid = struct.unpack('>L', txid)[0]
 
-        if l0 != l1:
-            print("length mismatch, framing error?")
+def parse_message(message):
+    # returns the message and whether its two length fields agreed
+    l0, len1_p, l1, code_p, code, txid = _message_header.unpack_from(message)
+    body = message[20:]
 
-        content = unpack_unknown(body)
+    assert len1_p == b'\x02\x04'
+    assert code_p == b'\x02\x04'
 
-        if txid == 0x11000100:
-            t = 'response'
-        elif (txid & 0xffffff00) == 0x11000100:
-            if code >= 2000:
-                t = 'async_ack'
-            else:
-                t = 'response'
-                assert content[0] == txid
-                content = content[1:]
-                body = body[6:]
+    if txid == 0x11000100:
+        t = 'response'
+    elif (txid & 0xffffff00) == 0x11000100:
+        if code >= 2000:
+            t = 'async_ack'
         else:
-            t = 'unsolicited'
+            t = 'response'
+            assert take_asn_int(body)[0] == txid
+            body = body[6:]
+    else:
+        t = 'unsolicited'
 
-        return {'tid': txid, 'type': t, 'code': code, 'body': body, 'content': content}
+    length_ok = l0 == int.from_bytes(l1.to_bytes(4, 'big'), 'little')
+    return Message(txid, t, code, body), length_ok
 
-    def handle_unsolicited(self, message):
-        name = rpc_unsol_table.xmm7360_unsol.get(message['code'], None)
 
-        if name == 'UtaMsNetIsAttachAllowedIndCb':
-            self.attach_allowed = message['content'][2]
+def describe_message(resp):
+    if resp.type == 'unsolicited':
+        return 'unsolicited: %s' % unsol_name(resp.code)
+    return resp.type
 
 
 def format_unknown(body):
+    return format_content(unpack_unknown(body))
+
+
+def format_content(content):
     out = []
-    for field in unpack_unknown(body):
+    for field in content:
         if isinstance(field, int):
             out.append('0x%x' % field)
         else:
@@ -133,135 +522,242 @@ def format_unknown(body):
     return ', '.join(out)
 
 
-def _pack_string(val, fmt, elem_type):
-    length_str = ''
-    while len(fmt) and fmt[0].isdigit():
-        length_str += fmt.pop(0)
+# element size shift for the three string types
+_string_shift = {0x55: 0, 0x56: 1, 0x57: 2}
 
-    length = int(length_str)
-    assert len(val) <= length
-    valid = len(val)
 
-    elem_size = len(struct.pack(elem_type, 0))
-    field_type = {1: 0x55, 2: 0x56, 4: 0x57}[elem_size]
-    payload = struct.pack('%d%s' % (valid, elem_type), *val)
+def take_asn_int(data, offset=0):
+    assert data[offset] == 0x02
+    l_data = data[offset + 1]
+    offset += 2
+    end = offset + l_data
+    if end > len(data):
+        raise ValueError("truncated int at offset %d" % offset)
+    return int.from_bytes(data[offset:end], 'big'), end
 
-    count = length * elem_size
-    padding = (length - valid) * elem_size
 
-    if valid < 128:
-        valid_field = struct.pack('B', valid)
-    else:
-        remain = valid
-        valid_field = [0x80]
-        while remain > 0:
-            valid_field[0] += 1
-            valid_field.insert(1, remain & 0xff)
-            remain >>= 8
-
-    field = struct.pack('B', field_type)
-    field += bytes(valid_field)
-    field += pack('LL', count, padding)
-    field += payload
-    field += b'\0' * padding
-    return field
-
-
-def take_asn_int(data):
-    assert data.pop(0) == 0x02
-    l_data = data.pop(0)
-    val = 0
-    for i in range(l_data):
-        val <<= 8
-        val |= data.pop(0)
-    return val
-
-
-def take_string(data):
-    t = data.pop(0)
-    assert t in [0x55, 0x56, 0x57]
-    valid = data.pop(0)
+def take_string(data, offset=0):
+    t = data[offset]
+    assert t in _string_shift
+    valid = data[offset + 1]
+    offset += 2
     if valid & 0x80:    # Variable length!
-        value = 0
-        for byte in range(valid & 0xf):  # lol
-            value |= data.pop(0) << (byte * 8)
-        valid = value
-    if t == 0x56:
-        valid <<= 1
-    elif t == 0x57:
-        valid <<= 2
+        n = valid & 0xf  # lol
+        valid = int.from_bytes(data[offset:offset + n], 'little')
+        offset += n
+    valid <<= _string_shift[t]
     # often equals valid + padding, but sometimes not
-    count = take_asn_int(data)
-    padding = take_asn_int(data)
+    count, offset = take_asn_int(data, offset)
+    padding, offset = take_asn_int(data, offset)
 
     if count:
         assert count == (valid + padding)
 
-    payload = data[:valid]
-    for i in range(valid + padding):
-        data.pop(0)  # eek
-    return payload
+    end = offset + valid
+    if end + padding > len(data):
+        raise ValueError("truncated string at offset %d" % offset)
+    return data[offset:end], end + padding
+
 
+def _take_string_bytes(data, offset):
+    payload, offset = take_string(data, offset)
+    return payload.tobytes(), offset
 
-def unpack_unknown(data):
+
+def unpack_unknown(data, copy=True):
+    # Walks the buffer with an offset instead of consuming it from the
+    # front. With copy=False, strings are memoryview slices of data.
     out = []
-    data = bytearray(data)
+    data = memoryview(data)
+    string = _take_string_bytes if copy else take_string
+    offset = 0
 
-    while len(data):
-        t = data[0]
+    while offset < len(data):
+        t = data[offset]
         if t == 0x02:
-            out.append(take_asn_int(data))
-        elif t in [0x55, 0x56, 0x57]:
-            out.append(take_string(data))
+            val, offset = take_asn_int(data, offset)
+        elif t in _string_shift:
+            val, offset = string(data, offset)
         else:
             raise ValueError("unknown type 0x%x" % t)
+        out.append(val)
 
     return out
 
 
-def unpack(fmt, data):
-    data = bytearray(data)
+def unpack(fmt, data, copy=True):
+    data = memoryview(data)
+    string = _take_string_bytes if copy else take_string
+    offset = 0
     out = []
     for ch in fmt:
         if ch == 'n':
-            val = take_asn_int(data)
-            out.append(val)
+            val, offset = take_asn_int(data, offset)
         elif ch == 's':
-            val = take_string(data)
-            out.append(val)
+            val, offset = string(data, offset)
         else:
             raise ValueError("unknown format char %s" % ch)
+        out.append(val)
 
     return out
 
 
-def pack(fmt, *args):
-    out = b''
-    fmt = list(fmt)
-    args = list(args)
-
-    while len(fmt):
-        arg = args.pop(0)
-        ch = fmt.pop(0)
-
-        if ch == 'B':
-            out += b'\x02\x01' + struct.pack('B', arg)
-        elif ch == 'H':
-            out += b'\x02\x02' + struct.pack('>H', arg)
-        elif ch == 'L':
-            out += b'\x02\x04' + struct.pack('>L', arg)
-        elif ch == 's':
-            out += _pack_string(arg, fmt, 'B')
-        elif ch == 'S':
-            elem_type = fmt.pop(0)
-            out += _pack_string(arg, fmt, elem_type)
+def _valid_field(valid):
+    if valid < 128:
+        return bytes((valid,))
+    n = (valid.bit_length() + 7) // 8
+    return bytes((0x80 + n,)) + valid.to_bytes(n, 'big')
+
+
+class _IntField(object):
+    def __init__(self, ch):
+        self.size = {'B': 3, 'H': 4, 'L': 6}[ch]
+        self.prefix = bytes((0x02, self.size - 2))
+        self.struct = struct.Struct('>2s' + ch)
+
+    def calcsize(self, val):
+        return self.size
+
+    def pack_into(self, buf, offset, val):
+        self.struct.pack_into(buf, offset, self.prefix, val)
+        return offset + self.size
+
+
+class _StringField(object):
+    count_padding = struct.Struct('>2sL2sL')
+
+    def __init__(self, length, elem_type):
+        self.length = length
+        self.elem_type = elem_type
+        self.elem_size = struct.calcsize(elem_type)
+        self.field_type = {1: 0x55, 2: 0x56, 4: 0x57}[self.elem_size]
+        self.count = length * self.elem_size
+        self.zeros = memoryview(bytes(self.count))
+        # type byte, valid count, count and padding ints, payload
+        self.size = 1 + 1 + 12 + self.count if length < 128 else None
+
+    def calcsize(self, val):
+        if self.size is not None:
+            return self.size
+        return 1 + len(_valid_field(len(val))) + 12 + self.count
+
+    def pack_into(self, buf, offset, val):
+        valid = len(val)
+        assert valid <= self.length
+        padding = (self.length - valid) * self.elem_size
+
+        buf[offset] = self.field_type
+        offset += 1
+        if valid < 128:
+            buf[offset] = valid
+            offset += 1
         else:
-            raise ValueError("Unknown format char '%s'" % ch)
+            vf = _valid_field(valid)
+            buf[offset:offset + len(vf)] = vf
+            offset += len(vf)
 
-    if len(args):
-        raise ValueError("Too many args supplied")
+        self.count_padding.pack_into(buf, offset, b'\x02\x04', self.count,
+                                     b'\x02\x04', padding)
+        offset += 12
 
-    return out
+        payload = valid * self.elem_size
+        if self.elem_type == 'B':
+            buf[offset:offset + payload] = val
+        else:
+            struct.pack_into('%d%s' % (valid, self.elem_type), buf, offset, *val)
+        offset += payload
+
+        buf[offset:offset + padding] = self.zeros[:padding]
+        return offset + padding
+
+
+class Codec(object):
+    """A pack format compiled once, like struct.Struct.
+
+    Codec('BLs20').pack(*args) gives the same bytes as pack('BLs20', *args),
+    written into a single preallocated buffer. pack_into() writes into a
+    caller-supplied buffer instead.
+    """
+
+    def __init__(self, fmt):
+        self.format = fmt
+        fields = []
+        unpack_fmt = ''
+        i = 0
+        while i < len(fmt):
+            ch = fmt[i]
+            i += 1
+            if ch in 'BHL':
+                fields.append(_IntField(ch))
+                unpack_fmt += 'n'
+                continue
+
+            if ch == 's':
+                elem_type = 'B'
+            elif ch == 'S':
+                elem_type = fmt[i]
+                i += 1
+            else:
+                raise ValueError("Unknown format char '%s'" % ch)
+
+            start = i
+            while i < len(fmt) and fmt[i].isdigit():
+                i += 1
+            if start == i:
+                raise ValueError("String without length in '%s'" % fmt)
+            fields.append(_StringField(int(fmt[start:i]), elem_type))
+            unpack_fmt += 's'
+
+        self.fields = tuple(fields)
+        self.unpack_format = unpack_fmt
+        sizes = [f.size for f in self.fields]
+        self.size = None if None in sizes else sum(sizes)
+
+    def _check_args(self, args):
+        if len(args) > len(self.fields):
+            raise ValueError("Too many args supplied")
+        if len(args) < len(self.fields):
+            raise ValueError("Too few args supplied")
+
+    def calcsize(self, *args):
+        if self.size is not None:
+            return self.size
+        self._check_args(args)
+        return sum(f.calcsize(arg) for f, arg in zip(self.fields, args))
+
+    def offsets(self, *args):
+        # start of each field, followed by the end of the message
+        self._check_args(args)
+        out = [0]
+        for field, arg in zip(self.fields, args):
+            out.append(out[-1] + field.calcsize(arg))
+        return out
+
+    def pack_into(self, buf, offset, *args):
+        self._check_args(args)
+        if offset + self.calcsize(*args) > len(buf):
+            raise ValueError("buffer too small")
+        for field, arg in zip(self.fields, args):
+            offset = field.pack_into(buf, offset, arg)
+        return offset
+
+    def pack(self, *args):
+        self._check_args(args)
+        buf = bytearray(self.calcsize(*args))
+        self.pack_into(buf, 0, *args)
+        return bytes(buf)
+
+    def unpack(self, data, copy=True):
+        return unpack(self.unpack_format, data, copy)
+
+
+@functools.lru_cache(maxsize=128)
+def compile_format(fmt):
+    return Codec(fmt)
+
+
+def pack(fmt, *args):
+    return compile_format(fmt).pack(*args)
 
 
 def bytes_to_ipv4(data):
@@ -272,15 +768,43 @@ def bytes_to_ipv6(data):
     return ipaddress.IPv6Address(int(binascii.hexlify(data), 16))
 
 
-def pack_UtaMsCallPsAttachApnConfigReq(apn):
+def _attach_apn_config_args(apn_string):
+    return [0, b'\0' * 257, 0, b'\0' * 65, b'\0' * 65, b'\0' * 250, 0, b'\0' * 250, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, b'\0' * 20, 0, b'\0' * 101, b'\0' * 257, 0, b'\0' * 65, b'\0' * 65, b'\0' * 250, 0, b'\0' * 250, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, b'\0' * 20, 0, b'\0' * 101,
+            b'\0' * 257, 0, b'\0' * 65, b'\0' * 65, b'\0' * 250, 0, b'\0' * 250, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0x404, 1, 0, 1, 0, 0, b'\0' * 20, 3, apn_string, b'\0' * 257, 0, b'\0' * 65, b'\0' * 65, b'\0' * 250, 0, b'\0' * 250, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0x404, 1, 0, 1, 0, 0, b'\0' * 20, 3, apn_string, 3, 0, ]
+
+
+_attach_apn_config_types = 'Bs260Ls66s65s250Bs252HLLLLLLLLLLLLLLLLLLLLLs20Ls104s260Ls66s65s250Bs252HLLLLLLLLLLLLLLLLLLLLLs20Ls104s260Ls66s65s250Bs252HLLLLLLLLLLLLLLLLLLLLLs20Ls104s260Ls66s65s250Bs252HLLLLLLLLLLLLLLLLLLLLLs20Ls103BL'
+
+
+def _build_UtaMsCallPsAttachApnConfigReq(apn):
     apn_string = bytearray(101)
     apn_string[:len(apn)] = apn.encode('ascii')
+    return pack(_attach_apn_config_types, *_attach_apn_config_args(apn_string))
+
+
+@functools.lru_cache(maxsize=None)
+def _attach_apn_config_template():
+    # Everything but the two APN strings is constant, so encode the message
+    # once with an empty APN and remember where the APN payloads start.
+    apn_string = bytes(101)
+    args = _attach_apn_config_args(apn_string)
+    codec = compile_format(_attach_apn_config_types)
+    offsets = codec.offsets(*args)
+    patch = tuple(offsets[i + 1] - codec.fields[i].count
+                  for i, arg in enumerate(args) if arg is apn_string)
+    return codec.pack(*args), patch
 
-    args = [0, b'\0' * 257, 0, b'\0' * 65, b'\0' * 65, b'\0' * 250, 0, b'\0' * 250, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, b'\0' * 20, 0, b'\0' * 101, b'\0' * 257, 0, b'\0' * 65, b'\0' * 65, b'\0' * 250, 0, b'\0' * 250, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, b'\0' * 20, 0, b'\0' * 101,
-            b'\0' * 257, 0, b'\0' * 65, b'\0' * 65, b'\0' * 250, 0, b'\0' * 250, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0x404, 1, 0, 1, 0, 0, b'\0' * 20, 3, apn_string, b'\0' * 257, 0, b'\0' * 65, b'\0' * 65, b'\0' * 250, 0, b'\0' * 250, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0x404, 1, 0, 1, 0, 0, b'\0' * 20, 3, apn_string, 3, 0, ]
 
-    types = 'Bs260Ls66s65s250Bs252HLLLLLLLLLLLLLLLLLLLLLs20Ls104s260Ls66s65s250Bs252HLLLLLLLLLLLLLLLLLLLLLs20Ls104s260Ls66s65s250Bs252HLLLLLLLLLLLLLLLLLLLLLs20Ls104s260Ls66s65s250Bs252HLLLLLLLLLLLLLLLLLLLLLs20Ls103BL'
-    return pack(types, *args)
+def pack_UtaMsCallPsAttachApnConfigReq(apn):
+    apn = apn.encode('ascii')
+    if len(apn) > 101:
+        raise ValueError("APN too long")
+
+    template, patch = _attach_apn_config_template()
+    msg = bytearray(template)
+    for offset in patch:
+        msg[offset:offset + len(apn)] = apn
+    return bytes(msg)
 
 
 def pack_UtaMsNetAttachReq():
@@ -337,53 +861,194 @@ def unpack_UtaSysGetInfo(body):
 
 def UtaSysGetInfo(rpc, index):
     resp = rpc.execute('UtaSysGetInfo', pack_UtaSysGetInfo(index))
-    return unpack_UtaSysGetInfo(resp['body'])
+    return unpack_UtaSysGetInfo(resp.body)
 
 
-def UtaModeSet(rpc, mode):
+def UtaModeSet(rpc, mode, timeout=None):
     mode_tid = 15
-    resp = rpc.execute('UtaModeSetReq', pack('LLL', 0, mode_tid, mode))
-    if resp['content'][0] != 0:
-        raise IOError("UtaModeSet failed. Bad value?")
-
-    while True:
-        msg = rpc.pump()
-        # msg['txid'] will be mode_tid as well
-        if rpc_unsol_table.xmm7360_unsol.get(msg['code'], None) == 'UtaModeSetRspCb':
-            if msg['content'][0] != mode:
-                raise IOError(
-                    "UtaModeSet was not able to set mode. FCC lock enabled?")
-            return
-
-
-def get_ip(r):
-    ip = r.execute('UtaMsCallPsGetNegIpAddrReq',
-                   pack_UtaMsCallPsGetNegIpAddrReq(), is_async=True)
-    ip_values = unpack_UtaMsCallPsGetNegIpAddrReq(ip['body'])
-
-    dns = r.execute('UtaMsCallPsGetNegotiatedDnsReq',
-                    pack_UtaMsCallPsGetNegotiatedDnsReq(), is_async=True)
-    dns_values = unpack_UtaMsCallPsGetNegotiatedDnsReq(dns['body'])
+    deadline = make_deadline(timeout)
+    done = rpc.unsolicited.queue('UtaModeSetRspCb')
+    try:
+        resp = rpc.execute('UtaModeSetReq', pack('LLL', 0, mode_tid, mode),
+                           timeout=deadline)
+        if resp.content[0] != 0:
+            raise IOError("UtaModeSet failed. Bad value?")
+
+        while not done:
+            rpc.pump(timeout=rpc.wait_time(deadline, 'UtaModeSetRspCb'),
+                     waiting_for='UtaModeSetRspCb')
+    finally:
+        rpc.unsolicited.unsubscribe('UtaModeSetRspCb', done.append)
+
+    # the message's txid will be mode_tid as well
+    if done[0].content[0] != mode:
+        raise IOError("UtaModeSet was not able to set mode. FCC lock enabled?")
+
+
+class IPConfig(collections.namedtuple('IPConfig',
+                                      'ipv4 dns_v4 dns_v6 ipv6_prefix')):
+    # The IPv4 addresses from GetNegIpAddr, the DNS servers, and on IPv6
+    # networks the /64 the modem was given, or None.
+    __slots__ = ()
+
+    @property
+    def address(self):
+        # use the last nonzero IP
+        return self.ipv4[-1] if self.ipv4 else None
+
+
+IPConfig.__new__.__defaults__ = (None,)
+
+
+def unpack_ip_config(ip_body, dns_body):
+    addresses = unpack_UtaMsCallPsGetNegIpAddrReq(ip_body)
+    dns = unpack_UtaMsCallPsGetNegotiatedDnsReq(dns_body)
+    ipv4 = tuple(a for a in addresses if int(a))
+    ipv6_prefix = None
+    # For some reason, on IPv6 networks, the GetNegIpAddrReq call returns
+    # 8 bytes of the IPv6 address followed by our 4 byte IPv4 address.
+    upper = addresses[0].packed + addresses[1].packed
+    if int(addresses[2]) and any(upper):
+        ipv4 = addresses[2:]
+        ipv6_prefix = ipaddress.IPv6Network((upper + bytes(8), 64))
+    return IPConfig(ipv4, tuple(dns['v4']), tuple(dns['v6']), ipv6_prefix)
+
+
+ip_config_calls = [
+    ('UtaMsCallPsGetNegIpAddrReq', pack_UtaMsCallPsGetNegIpAddrReq(), True),
+    ('UtaMsCallPsGetNegotiatedDnsReq', pack_UtaMsCallPsGetNegotiatedDnsReq(),
+     True),
+]
+
+
+def get_ip_config(r, timeout=None):
+    # both queries in flight at once, matched up by their tids
+    ip, dns = r.execute_many(ip_config_calls, timeout)
+    return unpack_ip_config(ip.body, dns.body)
+
+
+def get_ip(r, timeout=None):
+    config = get_ip_config(r, timeout)
+    if config.address is None:
+        return None, None
+    return config.address.compressed, {'v4': list(config.dns_v4),
+                                       'v6': list(config.dns_v6)}
+
+
+def attach(r, apn):
+    r.execute('UtaMsCallPsAttachApnConfigReq',
+              pack_UtaMsCallPsAttachApnConfigReq(apn), is_async=True)
+
+    attach = r.execute('UtaMsNetAttachReq', pack_UtaMsNetAttachReq(),
+                       is_async=True)
+    _, status = unpack('nn', attach.body)
+    if status != 0xffffffff:
+        return
 
-    # For some reason, on IPv6 networks, the GetNegIpAddrReq call returns 8 bytes of the IPv6 address followed by our 4 byte IPv4 address.
-    # use the last nonzero IP
-    for addr in ip_values[::-1]:
-        if addr.compressed != '0.0.0.0':
-            return addr.compressed, dns_values
-    return None, None
+    log.info("Attach failed - waiting to see if we just weren't ready")
+    while not r.attach_allowed:
+        r.pump(timeout=r.wait_time(None, 'UtaMsNetIsAttachAllowedIndCb'),
+               waiting_for='UtaMsNetIsAttachAllowedIndCb')
+
+    attach = r.execute('UtaMsNetAttachReq', pack_UtaMsNetAttachReq(),
+                       is_async=True)
+    _, status = unpack('nn', attach.body)
+    if status == 0xffffffff:
+        raise IOError("Attach failed again, giving up")
+
+
+# unsolicited messages after which an IP address may have been assigned
+ip_indications = [
+    'UtaMsCallPsActivateStatusIndCb',
+    'UtaMsCallPsNwActivateIndCb',
+    'UtaMsNetPsAttachIndCb',
+    'UtaMsNetRegistrationInfoIndCb',
+]
+
+
+def wait_for_ip(r, max_interval=1, first_interval=0.05, timeout=None,
+                min_interval=0.05):
+    # Ask again as soon as the modem indicates something has changed, or
+    # else on a backoff from first_interval up to max_interval, jittered
+    # so a fleet of machines doesn't poll in step. Polls are always at
+    # least min_interval apart, however many indications come in.
+    deadline = make_deadline(timeout)
+    changed = collections.deque()
+    for name in ip_indications:
+        r.unsolicited.subscribe(name, changed.append)
+    try:
+        interval = first_interval
+        while True:
+            changed.clear()
+            soonest = time.monotonic() + min_interval
+            ip_addr, dns_values = get_ip(r, deadline)
+            if ip_addr is not None:
+                return ip_addr, dns_values
+
+            delay = interval * random.uniform(0.5, 1)
+            log.info("IP address couldn't be fetched, retrying in %.2f "
+                     "seconds or on indication", delay)
+            start = time.monotonic()
+            poll_at = max(start + delay, soonest)
+            while True:
+                remaining = (soonest if changed else poll_at) - time.monotonic()
+                if remaining <= 0:
+                    break
+                limit = r.wait_time(deadline, 'IP address')
+                try:
+                    r.pump(timeout=remaining if limit is None
+                           else min(remaining, limit),
+                           waiting_for='IP address')
+                except RPCTimeout:
+                    pass
+            # the backoff between polls, cut short by any indication
+            if r.timeline is not None:
+                r.timeline.span('sleep', 'IP address backoff', start)
+            interval = min(interval * 2, max_interval)
+    finally:
+        for name in ip_indications:
+            r.unsolicited.unsubscribe(name, changed.append)
+
+
+def connect_datachannel(r):
+    # this gives us way too much stuff, which we need
+    pscr = r.execute('UtaMsCallPsConnectReq', pack_UtaMsCallPsConnectReq(),
+                     is_async=True)
+    # this gives us a handle we need
+    dcr = r.execute('UtaRPCPsConnectToDatachannelReq',
+                    pack_UtaRPCPsConnectToDatachannelReq())
+
+    csr_req = pscr.body[:-6] + dcr.body + b'\x02\x04\0\0\0\0'
+    r.execute('UtaRPCPSConnectSetupReq', csr_req)
+
+
+init_calls = [
+    'UtaMsSmsInit',
+    'UtaMsCbsInit',
+    'UtaMsNetOpen',
+    'UtaMsCallCsInit',
+    'UtaMsCallPsInitialize',
+    'UtaMsSsInit',
+    'UtaMsSimOpenReq',
+]
+
+
+def init_services(r):
+    # the init calls don't depend on each other, so pipeline them
+    return r.execute_many([(cmd,) for cmd in init_calls])
 
 
 def do_fcc_unlock(r):
     fcc_status_resp = r.execute('CsiFccLockQueryReq', is_async=True)
-    _, fcc_state, fcc_mode = unpack('nnn', fcc_status_resp['body'])
-    print("FCC lock: state %d mode %d" % (fcc_state, fcc_mode))
+    _, fcc_state, fcc_mode = unpack('nnn', fcc_status_resp.body)
+    log.info("FCC lock: state %d mode %d", fcc_state, fcc_mode)
     if not fcc_mode:
         return
     if fcc_state:
         return
 
     fcc_chal_resp = r.execute('CsiFccLockGenChallengeReq', is_async=True)
-    _, fcc_chal = unpack('nn', fcc_chal_resp['body'])
+    _, fcc_chal = unpack('nn', fcc_chal_resp.body)
     chal_bytes = struct.pack('<L', fcc_chal)
     # read out from nvm:fix_cat_fcclock.fcclock_hash[0]={0x3D,0xF8,0xC7,0x19}
     key = bytearray([0x3d, 0xf8, 0xc7, 0x19])
@@ -391,24 +1056,19 @@ def do_fcc_unlock(r):
     resp = struct.unpack('<L', resp_bytes[:4])[0]
     unlock_resp = r.execute('CsiFccLockVerChallengeReq',
                             pack('L', resp), is_async=True)
-    resp = unpack('n', unlock_resp['body'])[0]
+    resp = unpack('n', unlock_resp.body)[0]
     if resp != 1:
         raise IOError("FCC unlock failed")
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
     rpc = XMMRPC()
 
     fcc_status = rpc.execute('CsiFccLockQueryReq', is_async=True)
-    print("fcc status: %s" % binascii.hexlify(fcc_status['body']))
-
-    rpc.execute('UtaMsSmsInit')
-    rpc.execute('UtaMsCbsInit')
-    rpc.execute('UtaMsNetOpen')
-    rpc.execute('UtaMsCallCsInit')
-    rpc.execute('UtaMsCallPsInitialize')
-    rpc.execute('UtaMsSsInit')
-    rpc.execute('UtaMsSimOpenReq')
+    print("fcc status: %s" % binascii.hexlify(fcc_status.body))
+
+    init_services(rpc)
 
     do_fcc_unlock(rpc)
     UtaModeSet(rpc, 1)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Raw RPC frame capture for offline decoding.
+#
+# Frames are appended to a file as (timestamp, direction, length, frame)
+# records. The file and its predecessor act as a ring buffer: once the
+# current file reaches max_bytes it is renamed to <path>.1, replacing the
+# older one, and a new file is started.
+
+import os
+import sys
+import time
+import struct
+
+MAGIC = b'XMMRPCAP'
+
+_record = struct.Struct('<dBL')
+_directions = ('tx', 'rx')
+
+
+class FrameCapture(object):
+    def __init__(self, path, max_bytes=4 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.fp = None
+        # keep the previous run's capture around
+        if os.path.exists(path):
+            os.replace(path, path + '.1')
+        self._open()
+
+    def _open(self):
+        self.fp = open(self.path, 'wb')
+        self.fp.write(MAGIC)
+        self.size = len(MAGIC)
+
+    def rotate(self):
+        self.fp.close()
+        os.replace(self.path, self.path + '.1')
+        self._open()
+
+    def write(self, direction, frame):
+        length = _record.size + len(frame)
+        if self.size + length > self.max_bytes and self.size > len(MAGIC):
+            self.rotate()
+        self.fp.write(_record.pack(time.time(), _directions.index(direction),
+                                   len(frame)))
+        self.fp.write(frame)
+        # flushed so a capture survives the process dying
+        self.fp.flush()
+        self.size += length
+
+    def close(self):
+        self.fp.close()
+
+
+def read_capture(path):
+    # yields (timestamp, direction, frame), oldest first
+    for name in (path + '.1', path):
+        if not os.path.exists(name):
+            continue
+        with open(name, 'rb') as fp:
+            if fp.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not an RPC capture" % name)
+            while True:
+                header = fp.read(_record.size)
+                if len(header) < _record.size:
+                    break
+                timestamp, direction, length = _record.unpack(header)
+                frame = fp.read(length)
+                if len(frame) < length:
+                    break
+                yield timestamp, _directions[direction], frame
+
+
+def main(path):
+    import rpc
+    import rpc_call_ids
+
+    call_names = {v: k for k, v in rpc_call_ids.call_ids.items()}
+
+    for timestamp, direction, frame in read_capture(path):
+        try:
+            msg, length_ok = rpc.parse_message(frame)
+        except (ValueError, AssertionError, struct.error) as e:
+            print('%.6f %s undecodable frame (%s): %s' % (
+                timestamp, direction, str(e) or 'bad header', frame.hex()))
+            continue
+        if direction == 'tx':
+            desc = 'call: %s' % call_names.get(msg.code, '0x%x' % msg.code)
+        else:
+            desc = rpc.describe_message(msg)
+        if not length_ok:
+            desc += ' (length mismatch)'
+        try:
+            content = rpc.format_content(msg.content)
+        except (ValueError, AssertionError) as e:
+            content = 'undecodable (%s)' % e
+        print('%.6f %s %s: %s' % (timestamp, direction, desc, content))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Where the time goes during bring-up.
+#
+# A Timeline records the bring-up phases, every RPC call from request to
+# response, time spent waiting for unsolicited messages and time spent
+# sleeping. write() saves it in Chrome's trace event format, for
+# chrome://tracing or https://ui.perfetto.dev, and summary() gives a
+# table of the same.
+
+import os
+import json
+import time
+import itertools
+import contextlib
+import collections
+
+# rows in the trace viewer
+_tracks = {'phase': 1, 'rpc': 2, 'wait': 3, 'sleep': 4}
+
+
+def _covered(spans, lo, hi):
+    # seconds of [lo, hi) covered by any of the (start, end) spans
+    total = 0
+    end = lo
+    for s, e in sorted(spans):
+        s, e = max(s, end), min(e, hi)
+        if e > s:
+            total += e - s
+            end = e
+    return total
+
+
+class Timeline(object):
+    def __init__(self):
+        self.start = time.monotonic()
+        self.phases = []
+        # category -> [(start, end, name)]
+        self.spans = collections.defaultdict(list)
+        self.ids = itertools.count(1)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((start, time.monotonic(), name))
+
+    def span(self, cat, name, start, end=None):
+        if end is None:
+            end = time.monotonic()
+        self.spans[cat].append((start, end, name))
+
+    @contextlib.contextmanager
+    def measure(self, cat, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.span(cat, name, start)
+
+    def sleep(self, seconds, name='sleep'):
+        with self.measure('sleep', name):
+            time.sleep(seconds)
+
+    def _us(self, t):
+        return round((t - self.start) * 1e6, 1)
+
+    def trace_events(self):
+        pid = os.getpid()
+        events = [{'ph': 'M', 'pid': pid, 'tid': tid, 'name': 'thread_name',
+                   'args': {'name': cat}} for cat, tid in _tracks.items()]
+        for start, end, name in self.phases:
+            events.append({'ph': 'X', 'pid': pid, 'tid': _tracks['phase'],
+                           'cat': 'phase', 'name': name, 'ts': self._us(start),
+                           'dur': self._us(end) - self._us(start)})
+        # calls overlap when pipelined, so they are async events
+        for cat, spans in self.spans.items():
+            for start, end, name in spans:
+                common = {'pid': pid, 'tid': _tracks.get(cat, 0), 'cat': cat,
+                          'name': name, 'id': next(self.ids)}
+                events.append(dict(common, ph='b', ts=self._us(start)))
+                events.append(dict(common, ph='e', ts=self._us(end)))
+        return events
+
+    def write(self, path):
+        with open(path, 'w') as fp:
+            json.dump({'traceEvents': self.trace_events(),
+                       'displayTimeUnit': 'ms'}, fp)
+
+    def summary(self):
+        lines = ['%-20s %8s %6s %8s %8s %8s' % (
+            'phase', 'wall', 'calls', 'in rpc', 'waiting', 'sleeping')]
+        for start, end, name in self.phases:
+            calls = [s for s in self.spans['rpc'] if start <= s[0] < end]
+            lines.append('%-20s %7.3fs %6d %7.3fs %7.3fs %7.3fs' % (
+                name, end - start, len(calls),
+                _covered([s[:2] for s in self.spans['rpc']], start, end),
+                _covered([s[:2] for s in self.spans['wait']], start, end),
+                _covered([s[:2] for s in self.spans['sleep']], start, end)))
+
+        per_call = collections.defaultdict(list)
+        for start, end, name in self.spans['rpc']:
+            per_call[name].append(end - start)
+        lines.append('')
+        lines.append('%-36s %6s %8s %8s' % ('call', 'count', 'total', 'max'))
+        for name, times in sorted(per_call.items(), key=lambda i: -sum(i[1])):
+            lines.append('%-36s %6d %7.3fs %7.3fs' % (
+                name, len(times), sum(times), max(times)))
+        return '\n'.join(lines)
@@ -0,0 +1,192 @@
+import socket
+import asyncio
+import struct
+import binascii
+import collections
+import mux
+import fake_modem
+import tun
+
+
+def _parse(data):
+    stats = collections.Counter()
+    packets = [bytes(p) for p in mux.parse_frames(memoryview(data), stats)]
+    return packets, stats
+
+
+def test_parse_frames():
+    packets = [b'\x45' * 20, b'\x60' * 1400, b'\x45' * 3]
+    p = mux.MuxPacket(seq=3)
+    p.append_datagrams(packets)
+    frame = bytes(p.get_packet())
+
+    # bounds cover the 16 bytes of padding in front of each datagram
+    got, stats = _parse(frame)
+    assert got == [bytes(16) + packet for packet in packets]
+    assert stats['rx_frames'] == 1 and stats['rx_packets'] == 3
+
+    # an ACBH reply, then two data frames in the one read
+    p = mux.MuxPacket()
+    p.append_tag(b'ACBH')
+    p.append_tag(b'CMDH', struct.pack('<LLLL', 1, 0, 0, 0))
+    got, stats = _parse(bytes(p.get_packet()) + frame + frame)
+    assert len(got) == 6
+    assert stats['rx_other_frames'] == 1 and stats['rx_frames'] == 2
+
+    # the length is the u32 get_packet() writes, so 64 KiB or more is fine
+    big = b'\x60' * 70000
+    adth = 32 + len(big)
+    frame = struct.pack('<4sHHLL', b'ADBH', 0, 1, adth + 24, adth)
+    frame += bytes(16) + big
+    frame += struct.pack('<4sHHLLLL', b'ADTH', 24, 0, 0, 0, 16, 16 + len(big))
+    got, stats = _parse(frame)
+    assert got == [bytes(16) + big]
+    assert stats['rx_bad_frames'] == 0
+
+
+def test_parse_frames_chain():
+    # a QLTH ahead of the ADTH, a zero-length bound and one past the end
+    pkd = binascii.unhexlify('6000000000383AFFFE80000000000000')
+    p = mux.MuxPacket(seq=1)
+    p.append_tag(b'ADBH', pkd)
+    p.append_tag(b'QLTH', bytes(12))
+    p.append_tag(b'ADTH', struct.pack('<LLLLLLL', 0, 0x10, len(pkd),
+                                      0x10, 0, 0x10, 0x1000))
+    got, stats = _parse(bytes(p.get_packet()))
+    assert got == [pkd]
+    assert stats['rx_bad_bounds'] == 1
+
+    # a truncated frame is dropped, not read past
+    got, stats = _parse(bytes(p.get_packet())[:-4])
+    assert got == [] and stats['rx_bad_frames'] == 1
+
+
+def test_tun_batches():
+    # a seqpacket pair behaves like a TUN queue: a packet per read or write
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    a.setblocking(False)
+    b.setblocking(False)
+    packets = [bytes([i]) * (i + 1) for i in range(10)]
+    assert tun.write_batch(a.fileno(), packets) == 10
+    assert tun.read_batch(b.fileno(), 4) == packets[:4]
+    assert tun.read_batch(b.fileno(), 64) == packets[4:]
+    assert tun.read_batch(b.fileno(), 64) == []
+
+    # a full queue stops the batch rather than raising
+    sent = tun.write_batch(a.fileno(), [bytes(60000)] * 1000)
+    assert 0 < sent < 1000
+    a.close()
+    b.close()
+
+
+class _FakeTun(object):
+    def __init__(self, fd):
+        self.fds = [fd]
+
+    def fileno(self):
+        return self.fds[0]
+
+
+async def _run_mux():
+    loop = asyncio.get_running_loop()
+    modem, a = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    host, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    for s in (modem, a, host, b):
+        s.setblocking(False)
+
+    # start() without the device nodes
+    m = mux.XMMMux(max_queued=4)
+    m.loop = loop
+    m.fp = a.fileno()
+    m.tun = _FakeTun(b.fileno())
+    loop.add_reader(m.fp, m.read_mux)
+    m.resume_tun()
+
+    # uplink: packets from the TUN go out together in one frame
+    for i in range(3):
+        host.send(bytes([0x45]) * 100)
+    await asyncio.sleep(0.05)
+    frame = modem.recv(65536)
+    stats = collections.Counter()
+    assert len(list(mux.parse_frames(memoryview(frame), stats))) == 3
+
+    # downlink
+    modem.send(frame)
+    await asyncio.sleep(0.05)
+    assert host.recv(65536) == bytes(16) + bytes([0x45]) * 100
+
+    # a modem that stops reading stops the TUN being read
+    while m.tun_readers:
+        host.send(bytes(1400))
+        await asyncio.sleep(0.001)
+    assert len(m.tx_frames) == 4 and m.tx_backlog > 0
+    # and starts it again once it catches up
+    while True:
+        try:
+            modem.recv(65536)
+        except BlockingIOError:
+            break
+        await asyncio.sleep(0.001)
+    assert m.tun_readers
+
+    m.pause_tun()
+    loop.remove_reader(m.fp)
+    loop.remove_writer(m.fp)
+    for s in (modem, a, host, b):
+        s.close()
+
+
+def test_mux_backpressure():
+    asyncio.run(_run_mux())
+
+
+async def _run_echo():
+    host, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    host.settimeout(5)
+    b.setblocking(False)
+    # IPv4 UDP from 10.0.0.2:1000 to 10.0.0.1:2000
+    packet = bytes.fromhex('4500001c000000004011000a0a0000020a000001'
+                           '03e807d000080000')
+    with fake_modem.MuxEchoPeer() as peer:
+        m = mux.XMMMux(peer.fd, tun_device=_FakeTun(b.fileno()))
+        await m.start()
+        host.send(packet)
+        reply = await asyncio.get_running_loop().run_in_executor(
+            None, host.recv, 65536)
+        # too big for any frame: dropped, and the uplink carries on
+        host.send(bytes(20000))
+        host.send(packet)
+        second = await asyncio.get_running_loop().run_in_executor(
+            None, host.recv, 65536)
+        m.stop()
+    assert reply == second == fake_modem.reflect(packet)
+    assert reply[12:16] == packet[16:20] and reply[20:22] == packet[22:24]
+    assert peer.stats['rx_packets'] == 2
+    assert m.stats['tx_dropped'] == 1
+    host.close()
+    b.close()
+
+
+def test_mux_echo():
+    asyncio.run(_run_echo())
+
+
+def test_build_frame_full():
+    m = mux.XMMMux()
+    free = len(m.pool.free)
+    try:
+        m.build_frame([bytes(mux.MUX_MAX_FRAME)])
+    except ValueError:
+        pass
+    else:
+        assert False, "oversize frame was built"
+    assert len(m.pool.free) == free
+
+
+if __name__ == "__main__":
+    test_parse_frames()
+    test_parse_frames_chain()
+    test_tun_batches()
+    test_mux_backpressure()
+    test_mux_echo()
+    test_build_frame_full()
@@ -1,4 +1,17 @@
+import io
+import os
+import tty
+import time
+import tempfile
+import collections
+import struct
+import asyncio
+import contextlib
 import rpc
+import async_rpc
+import rpc_capture
+import fake_modem
+import rpc_timeline
 import binascii
 
 
@@ -168,6 +181,16 @@ def test_pack_UtaMsCallPsAttachApnConfigReq():
         "telstra.internet") == binascii.unhexlify(expected)
 
 
+def test_attach_apn_config_template():
+    for apn in ['', 'telstra.internet', 'internet', 'a' * 101]:
+        assert rpc.pack_UtaMsCallPsAttachApnConfigReq(apn) == \
+            rpc._build_UtaMsCallPsAttachApnConfigReq(apn)
+    # patching a copy must not leak into the next message
+    rpc.pack_UtaMsCallPsAttachApnConfigReq('a.very.long.apn.example')
+    assert rpc.pack_UtaMsCallPsAttachApnConfigReq('x') == \
+        rpc._build_UtaMsCallPsAttachApnConfigReq('x')
+
+
 def test_pack_UtaRPCPsConnectToDatachannelReq():
     expected = '55180204000000180204000000002F73696F7363632F504349452F494F534D2F4950532F3000'
     assert rpc.pack_UtaRPCPsConnectToDatachannelReq(
@@ -191,10 +214,447 @@ def test_pack_UtaMsCallPsConnectReq():
     assert rpc.pack_UtaMsCallPsConnectReq() == binascii.unhexlify(expected)
 
 
+def test_unpack_unknown():
+    body = rpc.pack_UtaMsCallPsAttachApnConfigReq("telstra.internet")
+    fields = rpc.unpack_unknown(body)
+    assert len(fields) == 131
+    assert fields[0] == 0
+    assert fields[1] == b'\0' * 257
+    assert fields[-3] == b'telstra.internet' + b'\0' * 85
+    assert fields[-2:] == [3, 0]
+
+
+def test_unpack_no_copy():
+    body = rpc.pack('Bs3L', 7, b'abc', 0x12345678)
+    n, s, word = rpc.unpack('nsn', body, copy=False)
+    assert (n, word) == (7, 0x12345678)
+    assert isinstance(s, memoryview)
+    assert s == b'abc'
+
+
+def test_unpack_truncated():
+    body = rpc.pack('s8', b'abcdefgh')
+    try:
+        rpc.unpack('s', body[:-1])
+    except ValueError:
+        pass
+    else:
+        assert False, "truncated string was accepted"
+
+
+def test_codec():
+    codec = rpc.Codec('BLLLLHHLL')
+    assert codec.pack(0, 0, 0, 0, 0, 0xffff, 0xffff, 0, 0) == \
+        rpc.pack_UtaMsNetAttachReq()
+    assert rpc.compile_format('BLLLLHHLL') is rpc.compile_format('BLLLLHHLL')
+
+    buf = bytearray(b'\xaa' * 64)
+    end = rpc.Codec('Hs4').pack_into(buf, 2, 0x1234, b'ab')
+    assert end == 2 + 4 + 18
+    assert buf[:end + 1] == binascii.unhexlify(
+        'aaaa02021234550202040000000402040000000261620000aa')
+    assert rpc.Codec('Hs4').unpack(buf[2:end]) == [0x1234, b'ab']
+
+
+def test_codec_strings():
+    assert rpc.pack('SH3', [1, 2]) == binascii.unhexlify(
+        '560202040000000602040000000201000200' '0000')
+    long_string = rpc.pack('s200', b'x' * 130)
+    assert long_string[:3] == b'\x55\x81\x82'
+    assert rpc.unpack('s', long_string) == [b'x' * 130]
+
+    for fmt, args in [('BL', (1,)), ('B', (1, 2))]:
+        try:
+            rpc.pack(fmt, *args)
+        except ValueError:
+            pass
+        else:
+            assert False, "bad argument count was accepted"
+
+
+def test_pipelined_calls():
+    r = rpc.XMMRPC(interfaces=[os.devnull])
+    ip = r.submit('UtaMsCallPsGetNegIpAddrReq', is_async=True)
+    dns = r.submit('UtaMsCallPsGetNegotiatedDnsReq', is_async=True)
+    sms = r.submit('UtaMsSmsInit')
+    cbs = r.submit('UtaMsCbsInit')
+    assert ip.tid != dns.tid
+    assert sorted(r.pending) == sorted([ip.tid, dns.tid])
+
+    r.process(rpc.build_message(2000 + 0x8d, rpc.asn_int4(0), dns.tid))
+    assert dns.acked and not dns.done()
+
+    r.process(rpc.build_message(0x8d, rpc.asn_int4(2), dns.tid))
+    r.process(rpc.build_message(0x30, rpc.asn_int4(3)))
+    r.process(rpc.build_message(0x8b, rpc.asn_int4(1), ip.tid))
+    r.process(rpc.build_message(0x25, rpc.asn_int4(4)))
+
+    assert ip.result().content == [1]
+    assert dns.result().content == [2]
+    assert sms.result().content == [3]
+    assert cbs.result().content == [4]
+    assert not r.pending and not r.pending_sync
+    assert r.latency['UtaMsSmsInit'].count == 1
+
+
+def _unsolicited(code, body):
+    length = len(body) + 16
+    return struct.pack('<L', length) + rpc.asn_int4(length) + \
+        rpc.asn_int4(code) + struct.pack('>L', 0) + body
+
+
+def _open_pty():
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    return master, slave, os.ttyname(slave)
+
+
+def test_async_rpc():
+    master, slave, path = _open_pty()
+
+    def modem():
+        request = os.read(master, 4096)
+        _, cmd = rpc.unpack('nn', request[4:16])
+        if cmd == rpc.rpc_call_ids.call_ids['UtaModeSetReq']:
+            # both in one write, so the reader has to split them
+            response = rpc.build_message(cmd, rpc.asn_int4(0))
+            os.write(master, response + _unsolicited(0x12d, rpc.asn_int4(1)))
+
+    async def main():
+        r = async_rpc.AsyncXMMRPC(interfaces=[path])
+        events = r.events()
+        r.loop.add_reader(master, modem)
+        await async_rpc.UtaModeSet(r, 1, timeout=5)
+        r.loop.remove_reader(master)
+        name, msg = await asyncio.wait_for(events.__anext__(), 5)
+        assert name == 'UtaModeSetRspCb'
+        assert msg.content == [1]
+
+        try:
+            await r.wait_for_unsolicited('UtaMsNetIsAttachAllowedIndCb',
+                                         timeout=0.01)
+        except rpc.RPCTimeout:
+            pass
+        else:
+            assert False, "wait_for_unsolicited didn't time out"
+        events.close()
+        r.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        os.close(master)
+        os.close(slave)
+
+
+def test_async_rpc_node_lost():
+    master, slave, path = _open_pty()
+
+    async def main():
+        r = async_rpc.AsyncXMMRPC(interfaces=[path])
+        events = r.events()
+        call = r.submit('UtaModeSetReq', rpc.pack('LLL', 0, 15, 1))
+        waiter = r.expect_unsolicited('UtaModeSetRspCb')
+        # the device going away makes reads on the node fail with EIO
+        os.close(master)
+        try:
+            await asyncio.wait_for(call.future, 5)
+        except OSError:
+            pass
+        else:
+            assert False, "call didn't fail"
+        assert isinstance(waiter.exception(), OSError)
+        assert [e async for e in events] == []
+        assert not r.loop.remove_reader(r.fp)
+        assert not r.pending and not r.pending_sync
+        r.close()
+
+        # and nothing more is written to the closed fd
+        try:
+            await asyncio.wait_for(r.execute('UtaMsSmsInit'), 0.5)
+        except OSError as e:
+            assert str(e) == "XMM RPC interface closed"
+        else:
+            assert False, "execute after close() didn't fail"
+
+    try:
+        asyncio.run(main())
+    finally:
+        os.close(slave)
+
+
+def test_timeout():
+    master, slave, path = _open_pty()
+    try:
+        r = rpc.XMMRPC(interfaces=[path])
+        try:
+            r.execute('CsiFccLockQueryReq', is_async=True, timeout=0.05)
+        except rpc.RPCTimeout as e:
+            assert e.command == 'CsiFccLockQueryReq'
+        else:
+            assert False, "execute didn't time out"
+        assert not r.pending
+
+        r.set_deadline(0.05)
+        try:
+            rpc.UtaModeSet(r, 1)
+        except rpc.RPCTimeout as e:
+            assert e.command == 'UtaModeSetReq'
+        else:
+            assert False, "deadline was ignored"
+        os.close(r.fp)
+    finally:
+        os.close(master)
+        os.close(slave)
+
+
+def test_latency_histogram():
+    hist = rpc.LatencyHistogram()
+    for seconds in [0.0005, 0.003, 0.003, 100]:
+        hist.add(seconds)
+    assert hist.buckets[0] == 1
+    assert hist.buckets[2] == 2
+    assert hist.buckets[-1] == 1
+    assert str(hist).startswith('n=4 ')
+
+
+def test_unsolicited_dispatch():
+    r = rpc.XMMRPC(interfaces=[os.devnull])
+    allowed = _unsolicited(0x6c, rpc.pack('LLL', 0, 0, 1))
+
+    seen = r.unsolicited.queue('UtaMsNetIsAttachAllowedIndCb')
+    r.process(allowed)
+    assert r.attach_allowed == 1
+    assert seen[0].content == [0, 0, 1]
+
+    # nobody listens for this one, so it is never decoded
+    msg = r.handle_message(_unsolicited(0x12d, rpc.asn_int4(1)))
+    r.unsolicited.dispatch(msg)
+    assert msg._content is None
+    assert msg.content == [1]
+    assert msg['code'] == 0x12d
+
+    r.unsolicited.unsubscribe('UtaMsNetIsAttachAllowedIndCb', seen.append)
+    r.process(allowed)
+    assert len(seen) == 1
+
+    try:
+        r.unsolicited.subscribe('NoSuchIndCb', print)
+    except ValueError:
+        pass
+    else:
+        assert False, "unknown unsolicited name was accepted"
+
+
+def test_capture(tmp_path):
+    path = os.path.join(str(tmp_path), 'xmm7360-test.cap')
+    r = rpc.XMMRPC(interfaces=[os.devnull])
+    r.capture = rpc_capture.FrameCapture(path, max_bytes=60)
+    call = r.submit('UtaMsSmsInit')
+    response = rpc.build_message(0x30, rpc.asn_int4(0))
+    r.process(response)
+    assert call.done()
+    r.capture.close()
+
+    frames = list(rpc_capture.read_capture(path))
+    assert [(d, f) for _, d, f in frames] == [
+        ('tx', rpc.build_message(0x30, rpc.asn_int4(0))), ('rx', response)]
+    assert r.stats['tx_frames'] == r.stats['rx_frames'] == 1
+    assert r.stats['rx_bytes'] == len(response)
+
+    # a malformed frame is shown as hex, and the dump carries on
+    capture = rpc_capture.FrameCapture(path)
+    capture.write('rx', b'\xff' * 24)
+    capture.write('rx', response)
+    capture.close()
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        rpc_capture.main(path)
+    # the earlier capture, now in .1, comes first
+    lines = out.getvalue().splitlines()[-2:]
+    assert 'undecodable frame' in lines[0] and 'ff' * 24 in lines[0]
+    assert ' rx response: ' in lines[1]
+    os.unlink(path)
+    os.unlink(path + '.1')
+
+
+def test_frame_reader():
+    rfd, wfd = os.pipe()
+    stats = collections.Counter()
+    reader = rpc.FrameReader(rfd, stats)
+    first = rpc.build_message(0x30, rpc.asn_int4(1))
+    second = rpc.build_message(0x31, rpc.pack('s300', b'x' * 257))
+
+    # one and a half messages, then the rest
+    os.write(wfd, first + second[:100])
+    reader.fill()
+    assert reader.next_frame() == first
+    assert reader.next_frame() is None
+    os.write(wfd, second[100:])
+    reader.fill()
+    assert reader.next_frame() == second
+    assert reader.next_frame() is None
+    assert stats['partial_reads'] == 1
+
+    os.write(wfd, b'\xff\xff\xff\xff' + first)
+    reader.fill()
+    assert reader.next_frame() is None
+    assert stats['framing_errors'] == 1
+
+    os.write(wfd, first)
+    reader.fill()
+    assert reader.next_frame() == first
+    os.close(rfd)
+    os.close(wfd)
+
+
+def test_fake_modem_bringup():
+    with fake_modem.FakeModem(latency=0.01, attach_failures=1,
+                              ip_delay=0.05) as modem:
+        r = rpc.XMMRPC(interfaces=[modem.path], timeout=5)
+        rpc.init_services(r)
+        rpc.do_fcc_unlock(r)
+        rpc.UtaModeSet(r, 1, timeout=5)
+        rpc.attach(r, 'internet')
+        ip_addr, dns_values = rpc.wait_for_ip(r, 0.02)
+        rpc.connect_datachannel(r)
+        os.close(r.fp)
+
+    assert ip_addr == '10.0.0.2'
+    assert [str(a) for a in dns_values['v4']] == ['10.0.0.1']
+    names = [name for t, name in modem.requests]
+    assert names.count('UtaMsNetAttachReq') == 2
+    assert names.count('UtaMsCallPsGetNegIpAddrReq') > 1
+    assert names[-1] == 'UtaRPCPSConnectSetupReq'
+
+
+def test_wait_for_ip():
+    # the indication cuts a long poll interval short
+    with fake_modem.FakeModem(ip_delay=0.2) as modem:
+        r = rpc.XMMRPC(interfaces=[modem.path], timeout=5)
+        rpc.attach(r, 'internet')
+        start = time.monotonic()
+        ip_addr, _ = rpc.wait_for_ip(r, max_interval=10, first_interval=5)
+        assert ip_addr == '10.0.0.2'
+        assert time.monotonic() - start < 2
+        os.close(r.fp)
+
+    # without one it backs off, and gives up at the deadline
+    with fake_modem.FakeModem(ip_delay=10, ip_indication=None) as modem:
+        r = rpc.XMMRPC(interfaces=[modem.path], timeout=5)
+        r.timeline = rpc_timeline.Timeline()
+        rpc.attach(r, 'internet')
+        try:
+            rpc.wait_for_ip(r, first_interval=0.02, timeout=0.3)
+        except rpc.RPCTimeout:
+            pass
+        else:
+            assert False, "wait_for_ip didn't time out"
+        os.close(r.fp)
+    polls = [t for t, name in modem.requests
+             if name == 'UtaMsCallPsGetNegIpAddrReq']
+    assert 4 <= len(polls) < 10
+    assert polls[-1] - polls[-2] > polls[1] - polls[0]
+    # the backoff shows up as sleeping
+    backoff = r.timeline.spans['sleep']
+    assert len(backoff) >= 3
+    assert set(name for _, _, name in backoff) == {'IP address backoff'}
+
+    # a burst of indications after every poll doesn't set off a poll storm
+    burst = [fake_modem.Event(0, rpc.ip_indications[0],
+                              trigger='UtaMsCallPsGetNegIpAddrReq')] * 5
+    with fake_modem.FakeModem(ip_delay=0.5, ip_indication=None,
+                              events=burst) as modem:
+        r = rpc.XMMRPC(interfaces=[modem.path], timeout=5)
+        rpc.attach(r, 'internet')
+        ip_addr, _ = rpc.wait_for_ip(r, max_interval=10, min_interval=0.1)
+        assert ip_addr == '10.0.0.2'
+        os.close(r.fp)
+    polls = [t for t, name in modem.requests
+             if name == 'UtaMsCallPsGetNegIpAddrReq']
+    assert 3 <= len(polls) <= 7
+    assert min(b - a for a, b in zip(polls, polls[1:])) >= 0.09
+
+
+def test_get_ip_config():
+    dns = [rpc.ipaddress.ip_address('10.0.0.1'),
+           rpc.ipaddress.ip_address('2001:db8::1')]
+    with fake_modem.FakeModem(latency=0.2, dns=dns) as modem:
+        r = rpc.XMMRPC(interfaces=[modem.path], timeout=5)
+        rpc.attach(r, 'internet')
+        start = time.monotonic()
+        config = rpc.get_ip_config(r)
+        # one round trip, not two
+        assert time.monotonic() - start < 0.35
+        os.close(r.fp)
+
+    assert config.ipv4 == (rpc.ipaddress.ip_address('10.0.0.2'),)
+    assert config.address.compressed == '10.0.0.2'
+    assert config.dns_v4 == (dns[0],) and config.dns_v6 == (dns[1],)
+    assert config.ipv6_prefix is None
+    empty = rpc.IPConfig((), (), ())
+    assert empty.address is None
+
+    # on IPv6 networks the first 8 bytes are the top of the IPv6 address
+    prefix = rpc.ipaddress.ip_address('2001:db8:1:2::').packed
+    addresses = [rpc.ipaddress.IPv4Address(prefix[:4]),
+                 rpc.ipaddress.IPv4Address(prefix[4:8]),
+                 rpc.ipaddress.ip_address('10.0.0.3')]
+    config = rpc.unpack_ip_config(fake_modem.pack_ip_response(addresses),
+                                  fake_modem.pack_dns_response(dns))
+    assert config.ipv4 == (addresses[2],)
+    assert str(config.ipv6_prefix) == '2001:db8:1:2::/64'
+
+
+def test_timeline():
+    tl = rpc_timeline.Timeline()
+    r = rpc.XMMRPC(interfaces=[os.devnull])
+    r.timeline = tl
+    with tl.phase('init'):
+        a = r.submit('UtaMsSmsInit')
+        b = r.submit('UtaMsCbsInit')
+        r.process(rpc.build_message(0x30, rpc.asn_int4(0)))
+        r.process(rpc.build_message(0x25, rpc.asn_int4(0)))
+        tl.sleep(0.01, 'retry')
+    assert a.done() and b.done()
+
+    assert [s[2] for s in tl.spans['rpc']] == ['UtaMsSmsInit', 'UtaMsCbsInit']
+    # overlapping calls count once towards the phase
+    assert rpc_timeline._covered([(0, 2), (1, 3), (5, 6)], 0, 10) == 4
+    assert rpc_timeline._covered([(0, 2), (1, 3)], 1.5, 2.5) == 1
+
+    row = tl.summary().splitlines()[1].split()
+    assert row[0] == 'init' and row[2] == '2'
+    assert float(row[-1].rstrip('s')) >= 0.01
+
+    events = tl.trace_events()
+    assert sum(e['ph'] == 'b' for e in events) == 3
+    assert sum(e['ph'] == 'e' for e in events) == 3
+    assert [e['name'] for e in events if e['ph'] == 'X'] == ['init']
+
+
 if __name__ == "__main__":
     print("running rpc tests")
     test_pack_UtaMsCallPsAttachApnConfigReq()
+    test_attach_apn_config_template()
     test_pack_UtaRPCPsConnectToDatachannelReq()
     test_pack_UtaMsNetAttachReq()
     test_pack_UtaMsCallPsGetNegIpAddrReq()
     test_pack_UtaMsCallPsConnectReq()
+    test_unpack_unknown()
+    test_unpack_no_copy()
+    test_unpack_truncated()
+    test_codec()
+    test_codec_strings()
+    test_pipelined_calls()
+    test_async_rpc()
+    test_async_rpc_node_lost()
+    test_unsolicited_dispatch()
+    test_capture(tempfile.mkdtemp())
+    test_frame_reader()
+    test_timeout()
+    test_latency_histogram()
+    test_fake_modem_bringup()
+    test_wait_for_ip()
+    test_get_ip_config()
+    test_timeline()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+# A TUN interface for the userspace mux, opened directly rather than
+# through pytap2 so it can have several queues and be read in batches.
+#
+# With IFF_MULTI_QUEUE each queue is its own fd on the same interface, and
+# the kernel spreads transmitted flows across them.
+
+import os
+import fcntl
+import socket
+import struct
+
+TUNSETIFF = 0x400454ca
+IFF_TUN = 0x0001
+IFF_NO_PI = 0x1000
+IFF_MULTI_QUEUE = 0x0100
+
+SIOCGIFFLAGS = 0x8913
+SIOCSIFFLAGS = 0x8914
+IFF_UP = 0x1
+
+# struct ifreq is 40 bytes: the name, then a union we only use the flags of
+_ifreq = struct.Struct('16sH22x')
+
+
+class TunDevice(object):
+    def __init__(self, name='tun%d', queues=1, dev='/dev/net/tun'):
+        flags = IFF_TUN | IFF_NO_PI
+        if queues > 1:
+            flags |= IFF_MULTI_QUEUE
+
+        self.fds = []
+        try:
+            for i in range(queues):
+                fd = os.open(dev, os.O_RDWR | os.O_NONBLOCK)
+                self.fds.append(fd)
+                ifr = fcntl.ioctl(fd, TUNSETIFF,
+                                  _ifreq.pack(name.encode(), flags))
+                # the first queue fixes the name, the rest attach to it
+                name = ifr[:16].rstrip(b'\0').decode()
+        except OSError:
+            self.close()
+            raise
+        self.name = name
+
+    def fileno(self):
+        return self.fds[0]
+
+    def up(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            ifr = fcntl.ioctl(s, SIOCGIFFLAGS, _ifreq.pack(self.name.encode(), 0))
+            flags = _ifreq.unpack(ifr)[1]
+            fcntl.ioctl(s, SIOCSIFFLAGS,
+                        _ifreq.pack(self.name.encode(), flags | IFF_UP))
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+
+def read_batch(fd, limit, size=65536):
+    # Every packet waiting on a non-blocking queue, up to limit. Each read
+    # returns one packet, so this is as batched as TUN gets.
+    packets = []
+    append = packets.append
+    read = os.read
+    try:
+        while len(packets) < limit:
+            append(read(fd, size))
+    except BlockingIOError:
+        pass
+    return packets
+
+
+def write_batch(fd, packets):
+    # Returns how many went out before the queue filled up.
+    write = os.write
+    for i, packet in enumerate(packets):
+        try:
+            write(fd, packet)
+        except BlockingIOError:
+            return i
+    return len(packets)
@@ -0,0 +1,216 @@
+import io
+import os
+import json
+import struct
+import tempfile
+import trace
+import trace_capture
+import trace_filter
+import trace_pipeline
+
+
+def _frame(packet):
+    return b'\x7e' + packet.replace(b'\x7d', b'\x7d\x5d') \
+        .replace(b'\x7e', b'\x7d\x5e')
+
+
+def test_unescape():
+    assert trace.unescape(b'plain') == b'plain'
+    assert trace.unescape(b'a\x7d\x5eb\x7d\x5dc') == b'a\x7eb\x7dc'
+    # an escaped 0x7d escapes nothing after it
+    assert trace.unescape(b'\x7d\x7d\x5e') == b'\x7d\x5e'
+    assert trace.unescape(b'ab\x7d') == b'ab'
+
+
+def test_deframer():
+    packets = [b'first \x7e packet', b'\x7d\x7d\x7e', bytes(range(256))]
+    stream = b'junk' + b''.join(map(_frame, packets)) + b'\x7e\x7e'
+
+    # however the stream is split up
+    for size in (1, 3, 64, len(stream)):
+        d = trace.Deframer()
+        got = []
+        for i in range(0, len(stream), size):
+            got += d.feed(stream[i:i + size])
+        assert got == packets
+
+    # packets are only whole once the next flag turns up
+    d = trace.Deframer()
+    assert d.feed(_frame(b'abc')) == []
+    assert d.feed(b'\x7e') == [b'abc']
+
+
+def test_read_packets(tmp_path):
+    path = os.path.join(str(tmp_path), 'test_trace.bin')
+    packets = [b'packet %d \x7e' % i for i in range(1000)]
+    with open(path, 'wb') as fp:
+        fp.write(b''.join(map(_frame, packets)) + b'\x7e')
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        assert list(trace.read_packets(fd, read_size=100)) == packets
+    finally:
+        os.close(fd)
+
+
+def test_decode_printf():
+    args = struct.pack('<3L', 7, 0xbeef, 0x1000) + b'name\0' + \
+        struct.pack('<L', 2)
+    record = b'%d %04x %p %s %lu\0' + args
+    assert trace.decode_printf(record) == '7 beef 0x1000 name 2'
+
+    trace.compile_printf.cache_clear()
+    trace.decode_printf(record)
+    trace.decode_printf(record)
+    assert trace.compile_printf.cache_info().hits == 1
+    # the three leading integers come out of one Struct
+    steps = trace.compile_printf(b'%d %04x %p %s %lu').steps
+    assert [s and s.format for s in steps] == ['<3L', None, '<1L']
+
+    assert trace.decode_printf(b'%q\0') == 'BAD PRINTF "%q" (q)'
+    assert trace.decode_printf(b'%d %d\0' + bytes(6)) == \
+        'BAD PRINTF "%d %d" (unpack requires a buffer of 4 bytes)'
+    # running out of arguments before a bad conversion is reported first
+    assert trace.decode_printf(b'%5d|%-3x\0' + bytes(2)) == \
+        'BAD PRINTF "%5d|%-3x" (unpack requires a buffer of 4 bytes)'
+    assert trace.decode_printf(b'%5d|%-3x\0' + bytes(4)) == \
+        'BAD PRINTF "%5d|%-3x" (-)'
+
+
+def _print_packet(text, stream=0):
+    # header, val 3 so the text starts at 0xd, then the checksum
+    return bytes([stream]) + bytes(6) + b'\x10\x03' + bytes(4) + text + bytes(5)
+
+
+def test_capture(tmp_path):
+    path = os.path.join(str(tmp_path), 'test_trace.cap')
+    for name in (path, path + '.idx'):
+        if os.path.exists(name):
+            os.remove(name)
+
+    capture = trace_capture.TraceCapture(path, block_size=256)
+    for i in range(100):
+        capture.write(_print_packet(b'line %d' % i, stream=i % 2), 1000.0 + i)
+    capture.write(b'\x00' * 7 + b'\x11', 1100.0)
+    capture.close()
+
+    reader = trace_capture.TraceReader(path)
+    assert len(reader.blocks) > 10
+    records = list(reader.records())
+    assert len(records) == 101
+    assert trace.decode_packet(records[2].packet) == 'line 2'
+    assert [r.timestamp for r in reader.records(1010.0, 1012.0)] == \
+        [1010.0, 1011.0, 1012.0]
+    assert [r.timestamp for r in reader.records(types=[0x11])] == [1100.0]
+    assert [r.packet for r in reader.records(1090.0, streams=[1])][0] == \
+        _print_packet(b'line 91', stream=1)
+    reader.close()
+
+    # a capture that died mid-block, and mid-record, picks up where it was
+    capture = trace_capture.TraceCapture(path, block_size=1 << 20)
+    capture.write(_print_packet(b'unindexed'), 1200.0)
+    capture.fp.flush()
+    capture.fp.write(b'\x01\x02')
+    capture.fp.flush()
+    reader = trace_capture.TraceReader(path)
+    assert reader.end_time == 1200.0
+    reader.close()
+
+    capture = trace_capture.TraceCapture(path)
+    capture.write(_print_packet(b'after'), 1300.0)
+    capture.close()
+    reader = trace_capture.TraceReader(path)
+    assert [trace.decode_packet(r.packet) for r in reader.records(1150.0)] == \
+        ['unindexed', 'after']
+    reader.close()
+
+    # without its index, a capture is indexed again from the start
+    os.remove(path + '.idx')
+    capture = trace_capture.TraceCapture(path, block_size=256)
+    capture.write(_print_packet(b'reindexed'), 1400.0)
+    capture.close()
+    reader = trace_capture.TraceReader(path)
+    assert len(reader.blocks) > 10
+    assert len(list(reader.records())) == 104
+    assert [r.timestamp for r in reader.records(1010.0, 1011.0)] == \
+        [1010.0, 1011.0]
+    reader.close()
+
+
+def _printf_packet(fmt, args=b'', stream=0):
+    return bytes([stream]) + bytes(6) + b'\x11\x00' + fmt + b'\0' + args + \
+        bytes(5)
+
+
+def test_filter():
+    noisy = _printf_packet(b'shm_sensor %d', struct.pack('<L', 1))
+    me = _printf_packet(b'%s', b'[ME] from an argument\0')
+    val = _printf_packet(b'val %d', struct.pack('<L', 5))
+    text = _print_packet(b'plain text')
+    packets = [noisy, me, val, text, _print_packet(b'other stream', stream=1)]
+
+    def shown(filt):
+        return [filt.decode(p) for p in packets]
+
+    f = trace_filter.Filter(exclude=trace_filter.DEFAULT_EXCLUDES)
+    assert shown(f) == [None, None, 'val 5', 'plain text', None]
+    # the noisy format is dropped without unpacking its arguments
+    assert f.formats[trace_filter.CHECK_INCLUDED][b'shm_sensor %d'][0] == \
+        trace_filter.DROP
+    assert f.formats[trace_filter.CHECK_INCLUDED][b'%s'][0] == \
+        trace_filter.CHECK_INCLUDED
+
+    f = trace_filter.Filter(include=['type=0x10'])
+    assert shown(f) == [None, None, None, 'plain text', None]
+    f = trace_filter.Filter(include=['format=^val', 'regex=ME.*argument'])
+    assert shown(f) == [None, '[ME] from an argument', 'val 5', None, None]
+    f = trace_filter.Filter(include=['text=val'], exclude=['stream=0'])
+    assert shown(f) == [None] * 5
+
+    try:
+        trace_filter.Filter(include=['colour=red'])
+    except ValueError:
+        pass
+    else:
+        assert False
+
+    out, js = io.StringIO(), io.StringIO()
+    router = trace_filter.Router(
+        trace_filter.Filter(include=['type=0x11']),
+        [trace_filter.TextSink(out), trace_filter.JsonSink(js)])
+    router.handle(packets, 1000.0)
+    assert out.getvalue() == 'shm_sensor 1\n[ME] from an argument\nval 5\n'
+    lines = [json.loads(line) for line in js.getvalue().splitlines()]
+    assert lines[2] == {'time': 1000.0, 'stream': 0, 'type': 0x11,
+                        'text': 'val 5'}
+
+
+def test_pipeline():
+    packets = [_printf_packet(b'%d', struct.pack('<L', i)) for i in range(5000)]
+    packets.append(_printf_packet(b'shm_sensor'))
+    out = []
+
+    class Sink(object):
+        def write(self, messages, timestamp):
+            out.extend(msg for packet, msg in messages)
+
+        def close(self):
+            pass
+
+    router = trace_filter.Router(trace_filter.Filter(), [Sink()])
+    pipeline = trace_pipeline.Pipeline(
+        router, exclude=trace_filter.DEFAULT_EXCLUDES, jobs=2, max_pending=2)
+    # with batches in flight on both decoders at once
+    for i in range(0, len(packets), 700):
+        pipeline.handle(packets[i:i + 700], 1000.0)
+    pipeline.close()
+    assert out == [str(i) for i in range(5000)]
+
+
+if __name__ == "__main__":
+    test_unescape()
+    test_deframer()
+    test_read_packets(tempfile.mkdtemp())
+    test_decode_printf()
+    test_capture(tempfile.mkdtemp())
+    test_filter()
+    test_pipeline()
@@ -1,125 +1,280 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import struct
-import sys
+import functools
 
-fd = os.open(sys.argv[1], os.O_RDONLY)
+# HDLC-style framing: packets are separated by 0x7e, and 0x7e and 0x7d
+# within one are sent as 0x7d followed by the byte with bit 5 set
+FLAG = b'\x7e'
+ESCAPE = b'\x7d'
+_unescape_table = bytes(ch | (1 << 5) for ch in range(256))
 
 
-def log(msg):
-    if 'shm_sensor' in msg:
-        return
-    if 'store_metric' in msg:
-        return
-    if '[ME]' in msg:
-        return
-    print(msg.strip())
+def unescape(packet):
+    # The bytes between escapes are copied whole; only the byte after
+    # each escape is looked at on its own.
+    if ESCAPE not in packet:
+        return bytes(packet)
+    parts = packet.split(ESCAPE)
+    out = [parts[0]]
+    i = 1
+    while i < len(parts):
+        part = parts[i]
+        if part:
+            out.append(part[:1].translate(_unescape_table))
+            out.append(part[1:])
+        elif i + 1 < len(parts):
+            # an escaped escape; what follows it is not escaped
+            out.append(ESCAPE)
+            i += 1
+            out.append(parts[i])
+        i += 1
+    return b''.join(out)
 
 
-def unescape(packet):
-    out = bytearray()
-    packet = iter(packet)
-    for ch in packet:
-        if ch == 0x7d:
-            ch = next(packet) | (1 << 5)
-        out.append(ch)
-    return out
+class Deframer(object):
+    # Splits a stream into packets. Data is appended to one buffer and
+    # scanned from a cursor; consumed bytes are dropped once per feed().
 
+    def __init__(self, max_packet=1 << 20):
+        self.buf = bytearray()
+        self.synced = False
+        self.max_packet = max_packet
 
-def decode_printf(payload):
-    def take_string(payload):
-        string, _, payload = payload.partition(b'\0')
-        return payload, string.decode('ascii', errors='replace')
+    def feed(self, data):
+        # returns the unescaped packets completed by data
+        buf = self.buf
+        buf.extend(data)
+        if not self.synced:
+            start = buf.find(FLAG)
+            if start < 0:
+                buf.clear()
+                return []
+            del buf[:start]
+            self.synced = True
 
-    def take_int(payload):
-        val = struct.unpack('<L', payload[:4])[0]
-        payload = payload[4:]
-        return payload, val
+        packets = []
+        find = buf.find
+        pos = 0
+        end = find(FLAG, 1)
+        while end >= 0:
+            if end > pos + 1:
+                packets.append(unescape(buf[pos + 1:end]))
+            pos = end
+            end = find(FLAG, pos + 1)
+        del buf[:pos]
 
-    payload, fmt = take_string(payload)
+        if len(buf) > self.max_packet:
+            # no end in sight, start again at the next flag
+            buf.clear()
+            self.synced = False
+        return packets
 
-    # print(fmt)
 
-    try:
-        where = fmt.find('%')
-        args = []
-        while where >= 0:
-            atype = fmt[where + 1]
-            while atype.isdigit() or atype.isspace() or atype in '.l':
-                where += 1
+def read_batches(fd, read_size=1048576):
+    # the packets completed by each read, as a list
+    deframer = Deframer()
+    chunk = bytearray(read_size)
+    view = memoryview(chunk)
+    while True:
+        n = os.readv(fd, [chunk])
+        if not n:
+            break
+        yield deframer.feed(view[:n])
+
+
+def read_packets(fd, read_size=1048576):
+    for packets in read_batches(fd, read_size):
+        yield from packets
+
+
+class PrintfFormat(object):
+    # A firmware format string, scanned once for its argument types.
+    # Consecutive integer arguments are unpacked with a single Struct.
+
+    def __init__(self, raw):
+        self.fmt = raw.decode('ascii', errors='replace')
+        # a Struct for each run of integers, None for each string
+        self.steps = []
+        self.error = None
+        try:
+            self._compile()
+        except Exception as e:
+            self.error = e
+        self.out_fmt = self.fmt.replace('%p', '0x%x')
+
+    def _compile(self):
+        fmt = self.fmt
+        kinds = ''
+        try:
+            where = fmt.find('%')
+            while where >= 0:
                 atype = fmt[where + 1]
+                while atype.isdigit() or atype.isspace() or atype in '.l':
+                    where += 1
+                    atype = fmt[where + 1]
 
-            # print(atype, ''.join('%02x ' % ch for ch in payload))
+                if atype == 's':
+                    kinds += 's'
+                elif atype in 'dxpui':
+                    kinds += 'L'
+                else:
+                    raise ValueError(atype)
 
-            if atype == 's':
-                payload, arg = take_string(payload)
-                args.append(arg)
-            elif atype in 'dxpui':
-                payload, arg = take_int(payload)
-                args.append(arg)
-            else:
-                raise ValueError(atype)
+                where = fmt.find('%', where + 1)
+        finally:
+            # the arguments before a bad conversion are still unpacked, as
+            # running out of them is reported ahead of it
+            for run in kinds.replace('s', ' s ').split(' '):
+                if run == 's':
+                    self.steps.append(None)
+                elif run:
+                    self.steps.append(struct.Struct('<%dL' % len(run)))
 
-            where = fmt.find('%', where + 1)
+    def format(self, payload, offset=0):
+        args = []
+        try:
+            for step in self.steps:
+                if step is None:
+                    end = payload.find(b'\0', offset)
+                    if end < 0:
+                        end = len(payload)
+                    args.append(payload[offset:end].decode('ascii',
+                                                           errors='replace'))
+                    offset = end + 1
+                else:
+                    args.extend(step.unpack_from(payload, offset))
+                    offset += step.size
+        except struct.error:
+            # as reported when the arguments were unpacked one at a time
+            return 'BAD PRINTF "%s" (unpack requires a buffer of 4 bytes)' \
+                % self.fmt
+        if self.error is not None:
+            return 'BAD PRINTF "%s" (%s)' % (self.fmt, self.error)
 
-        fmt = fmt.replace('%p', '0x%x')
+        try:
+            return self.out_fmt % tuple(args)
+        except Exception as e:
+            return 'BAD PRINTF "%s" (%s)' % (self.out_fmt, e)
 
-        return fmt % tuple(args)
 
-    except Exception as e:
-        return 'BAD PRINTF "%s" (%s)' % (fmt, e)
+@functools.lru_cache(maxsize=8192)
+def compile_printf(raw):
+    return PrintfFormat(raw)
 
 
-def handle_packet(packet):
-    stream, seq = struct.unpack('BB', packet[:2])
+def decode_printf(payload):
+    # the format string, then its arguments packed one after another
+    end = payload.find(b'\0')
+    if end < 0:
+        return compile_printf(bytes(payload)).format(b'')
+    return compile_printf(bytes(payload[:end])).format(payload, end + 1)
+
 
+def packet_type(packet):
+    # stream and type byte, for packets too short to have one as well
+    stream = packet[0] if packet else 0
+    return stream, packet[7] if len(packet) > 7 else 0
+
+
+def packet_payload(packet):
+    # the type byte and payload of a print or printf, or None
     if len(packet) < 13:
-        return
+        return None
+    stream, seq = struct.unpack('BB', packet[:2])
+
     if stream != 0 or packet[7] not in [0x10, 0x11]:
-        return
+        return None
 
     # print(''.join('%02x ' % ch for ch in packet))
 
     # strip checksum
     packet = packet[:-5]
 
-    if stream == 0x00 and len(packet) > 8:
-        typ = packet[7]
+    if len(packet) > 8:
         val = packet[8]
         if val == 0:
-            payload = packet[0x9:]
+            return packet[7], packet[0x9:]
         elif val == 3:
-            payload = packet[0xd:]
-        else:
-            return
-        if typ == 0x10:  # print
-            log(payload.decode('ascii', errors='replace'))
-        if typ == 0x11:  # printf
-            log(decode_printf(payload))
-
-
-buf = b''
-
-while True:
-    new = os.read(fd, 1048576)
-    if not len(new):
-        break
-    buf += new
-    start = buf.find(b'\x7e')
-    if start < 0:
-        buf = b''
-        continue
-    buf = buf[start:]
+            return packet[7], packet[0xd:]
+    return None
 
-    while True:
-        end = buf.find(b'\x7e', 1)
-        if end < 0:
-            break
-        packet = buf[1:end]
-        buf = buf[end:]
 
-        if not len(packet):
-            continue
+def decode_packet(packet):
+    # the log line a packet carries, or None
+    found = packet_payload(packet)
+    if found is None:
+        return None
+    typ, payload = found
+    if typ == 0x10:  # print
+        return payload.decode('ascii', errors='replace')
+    return decode_printf(payload)  # printf
+
+
+def main():
+    import argparse
+    import trace_capture
+    import trace_filter
+    import trace_pipeline
+
+    parser = argparse.ArgumentParser(
+        description="Print the modem's firmware trace")
+    parser.add_argument('device', help="trace device or a raw dump of one")
+    parser.add_argument('--capture', metavar='PATH',
+                        help="also keep every packet in PATH, for trace_capture.py")
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="don't print, only capture")
+    parser.add_argument('-i', '--include', metavar='RULE', action='append',
+                        default=[],
+                        help="only show messages matching a rule: stream=N, "
+                        "type=N, format=REGEX, text=STRING or regex=REGEX")
+    parser.add_argument('-x', '--exclude', metavar='RULE', action='append',
+                        default=[], help="hide messages matching a rule")
+    parser.add_argument('-a', '--all', action='store_true',
+                        help="don't hide the usual noisy messages")
+    parser.add_argument('-o', '--output', metavar='SINK', action='append',
+                        help="- for stdout, PATH, or json:PATH for JSON lines; "
+                        "may be given more than once")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="decode in this many processes, 0 for one per CPU")
+    args = parser.parse_args()
+
+    exclude = args.exclude
+    if not args.all:
+        exclude = trace_filter.DEFAULT_EXCLUDES + exclude
+    try:
+        filt = trace_filter.Filter(args.include, exclude)
+    except (ValueError, re.error) as e:
+        parser.error(str(e))
+
+    router = None
+    if not args.quiet:
+        router = trace_filter.Router(
+            filt, [trace_filter.open_sink(s) for s in args.output or ['-']])
+        if args.jobs != 1:
+            router = trace_pipeline.Pipeline(router, args.include, exclude,
+                                             args.jobs)
+
+    capture = None
+    if args.capture:
+        capture = trace_capture.TraceCapture(args.capture)
+
+    fd = os.open(args.device, os.O_RDONLY)
+    try:
+        for packets in read_batches(fd):
+            if capture is not None:
+                for packet in packets:
+                    capture.write(packet)
+            if router is not None:
+                router.handle(packets)
+    finally:
+        if capture is not None:
+            capture.close()
+        if router is not None:
+            router.close()
+
 
-        handle_packet(unescape(packet))
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+# Firmware trace capture, and queries over it.
+#
+# Every deframed packet is appended to <path> as a (timestamp, stream,
+# type, length) record and the packet itself. Records are grouped into
+# blocks of about 64 KiB, and <path>.idx gets an entry per block: its time
+# span, where it lies in <path>, and a bitmap of the packet types in it.
+# A query reads only the blocks that can hold what it asks for.
+#
+# Capturing to an existing file carries on at its end. Records written
+# after the last index entry, e.g. by a capture that was killed, are
+# indexed when the file is next opened.
+
+import os
+import sys
+import time
+import bisect
+import struct
+import collections
+
+import trace
+
+MAGIC = b'XMMTRACE'
+INDEX_MAGIC = b'XMMTRIDX'
+
+_record = struct.Struct('<dBBL')
+# first and last timestamp, start and end offset, record count, types
+_block = struct.Struct('<ddQQL32s')
+
+Record = collections.namedtuple('Record', 'timestamp stream type packet')
+
+
+class Block(object):
+    def __init__(self, start):
+        self.first = None
+        self.last = None
+        self.start = start
+        self.end = start
+        self.count = 0
+        self.types = 0
+
+    def add(self, timestamp, typ, size):
+        if self.first is None:
+            self.first = timestamp
+        self.last = timestamp
+        self.end += size
+        self.count += 1
+        self.types |= 1 << typ
+
+    def pack(self):
+        return _block.pack(self.first, self.last, self.start, self.end,
+                           self.count, self.types.to_bytes(32, 'little'))
+
+    @classmethod
+    def unpack(cls, data):
+        first, last, start, end, count, types = _block.unpack(data)
+        block = cls(start)
+        block.first, block.last, block.end, block.count = first, last, end, count
+        block.types = int.from_bytes(types, 'little')
+        return block
+
+    def has_type(self, types):
+        return any(self.types >> typ & 1 for typ in types)
+
+
+def _scan(fp, offset, end):
+    # (offset, timestamp, stream, type, packet) for the whole records in
+    # [offset, end) of a capture
+    fp.seek(offset)
+    while offset + _record.size <= end:
+        header = fp.read(_record.size)
+        if len(header) < _record.size:
+            return
+        timestamp, stream, typ, length = _record.unpack(header)
+        if offset + _record.size + length > end:
+            return
+        packet = fp.read(length)
+        yield offset, timestamp, stream, typ, packet
+        offset += _record.size + length
+
+
+def _read_index(path):
+    blocks = []
+    if not os.path.exists(path + '.idx'):
+        return blocks
+    with open(path + '.idx', 'rb') as fp:
+        if fp.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError("%s.idx is not a trace index" % path)
+        while True:
+            data = fp.read(_block.size)
+            if len(data) < _block.size:
+                break
+            blocks.append(Block.unpack(data))
+    return blocks
+
+
+def _tail_block(fp, start, end):
+    # index whatever follows the last indexed block
+    block = Block(start)
+    for offset, timestamp, stream, typ, packet in _scan(fp, start, end):
+        block.add(timestamp, typ, _record.size + len(packet))
+    return block
+
+
+class TraceCapture(object):
+    def __init__(self, path, block_size=65536):
+        self.path = path
+        self.block_size = block_size
+
+        if not os.path.exists(path):
+            with open(path, 'wb') as fp:
+                fp.write(MAGIC)
+        if not os.path.exists(path + '.idx') or \
+                not os.path.getsize(path + '.idx'):
+            # a new capture, or one whose index has gone missing
+            with open(path + '.idx', 'wb') as fp:
+                fp.write(INDEX_MAGIC)
+
+        self.fp = open(path, 'r+b')
+        if self.fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a trace capture" % path)
+        blocks = _read_index(path)
+        self.index = open(path + '.idx', 'ab')
+
+        # index what follows the last indexed block, a block at a time
+        start = blocks[-1].end if blocks else len(MAGIC)
+        self.block = Block(start)
+        for offset, timestamp, stream, typ, packet in \
+                _scan(self.fp, start, os.path.getsize(path)):
+            self.add(timestamp, typ, _record.size + len(packet))
+        # drop a record cut short by the last capture dying
+        self.fp.truncate(self.block.end)
+        self.fp.seek(self.block.end)
+
+    def write(self, packet, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        stream, typ = trace.packet_type(packet)
+        self.fp.write(_record.pack(timestamp, stream, typ, len(packet)))
+        self.fp.write(packet)
+        self.add(timestamp, typ, _record.size + len(packet))
+
+    def add(self, timestamp, typ, size):
+        self.block.add(timestamp, typ, size)
+        if self.block.end - self.block.start >= self.block_size:
+            self.end_block()
+
+    def end_block(self):
+        if not self.block.count:
+            return
+        # the data has to be there before the index says it is
+        self.fp.flush()
+        self.index.write(self.block.pack())
+        self.index.flush()
+        self.block = Block(self.block.end)
+
+    def close(self):
+        self.end_block()
+        self.fp.close()
+        self.index.close()
+
+
+class TraceReader(object):
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, 'rb')
+        if self.fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a trace capture" % path)
+        self.blocks = _read_index(path)
+        start = self.blocks[-1].end if self.blocks else len(MAGIC)
+        tail = _tail_block(self.fp, start, os.path.getsize(path))
+        if tail.count:
+            self.blocks.append(tail)
+        self.last_times = [b.last for b in self.blocks]
+
+    def close(self):
+        self.fp.close()
+
+    @property
+    def start_time(self):
+        return self.blocks[0].first if self.blocks else None
+
+    @property
+    def end_time(self):
+        return self.blocks[-1].last if self.blocks else None
+
+    def records(self, start=None, end=None, types=None, streams=None):
+        # Records from start to end (absolute timestamps), of the given
+        # type bytes and streams, oldest first. Packets are not decoded.
+        first = 0
+        if start is not None:
+            first = bisect.bisect_left(self.last_times, start)
+        for block in self.blocks[first:]:
+            if end is not None and block.first > end:
+                break
+            if types is not None and not block.has_type(types):
+                continue
+            for offset, timestamp, stream, typ, packet in \
+                    _scan(self.fp, block.start, block.end):
+                if start is not None and timestamp < start:
+                    continue
+                if end is not None and timestamp > end:
+                    break
+                if types is not None and typ not in types:
+                    continue
+                if streams is not None and stream not in streams:
+                    continue
+                yield Record(timestamp, stream, typ, packet)
+
+
+def _number(text):
+    return int(text, 0)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Query a trace capture")
+    parser.add_argument('path')
+    parser.add_argument('--start', type=float,
+                        help="seconds from the start of the capture")
+    parser.add_argument('--end', type=float,
+                        help="seconds from the start of the capture")
+    parser.add_argument('--type', type=_number, action='append',
+                        help="only this type byte, e.g. 0x11")
+    parser.add_argument('--stream', type=_number, action='append')
+    parser.add_argument('--hex', action='store_true',
+                        help="show packets that don't decode as hex")
+    args = parser.parse_args()
+
+    reader = TraceReader(args.path)
+    if reader.start_time is None:
+        return
+    start = end = None
+    if args.start is not None:
+        start = reader.start_time + args.start
+    if args.end is not None:
+        end = reader.start_time + args.end
+
+    for record in reader.records(start, end, args.type, args.stream):
+        msg = trace.decode_packet(record.packet)
+        if msg is None:
+            if not args.hex:
+                continue
+            msg = '%02x/%02x %s' % (record.stream, record.type,
+                                    record.packet.hex())
+        when = time.strftime('%H:%M:%S', time.localtime(record.timestamp))
+        print('%s.%06d %s' % (when, record.timestamp % 1 * 1e6, msg.strip()))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except BrokenPipeError:
+        sys.exit(1)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+# Which trace messages get shown, and where they go.
+#
+# A rule is FIELD=VALUE, included or excluded:
+#
+#   stream=0        the packet's stream
+#   type=0x11       its type byte, 0x10 print or 0x11 printf
+#   format=REGEX    searched for in the printf format string, or the
+#                   text of a print
+#   text=STRING     a substring of the decoded message
+#   regex=REGEX     searched for in the decoded message
+#
+# A message is shown if it matches no exclude rule and, when there are
+# include rules, at least one of them.
+#
+# Filter works out as much as it can before decoding. The stream and type
+# byte are looked up in a table built from the rules. Each printf format
+# string is checked once and the outcome kept, so for most messages the
+# arguments are never unpacked; a text= rule is settled there too when
+# its string is in the format's literal text. Only what is left is
+# decoded and tested, with one function for all the excludes and one for
+# all the includes.
+
+import re
+import sys
+import json
+import time
+
+import trace
+
+# the filters trace.py has always had
+DEFAULT_EXCLUDES = ['text=shm_sensor', 'text=store_metric', 'text=[ME]']
+
+# how a packet fares on its stream and type byte, or its format string
+DROP, KEEP, CHECK, CHECK_INCLUDED = range(4)
+
+# a conversion, as far as PrintfFormat reads one
+_conversion = re.compile(r'%[0-9\s.l]*.', re.DOTALL)
+
+
+def parse_rule(spec):
+    field, sep, value = spec.partition('=')
+    if not sep or field not in ('stream', 'type', 'format', 'text', 'regex'):
+        raise ValueError("bad filter rule %r, expected FIELD=VALUE" % spec)
+    if field in ('stream', 'type'):
+        return field, int(value, 0)
+    return field, value
+
+
+def _combine(patterns):
+    # one regex matching any of them, or None
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:%s)' % p for p in patterns))
+
+
+def _matcher(literals, patterns):
+    # One function of a message, true if it contains any of the literals
+    # or matches any of the regexes, or None. A substring test is a lot
+    # cheaper than a regex, so the literals are tested as they are.
+    if not literals and not patterns:
+        return None
+    literals = tuple(literals)
+    search = _combine(patterns).search if patterns else None
+
+    def match(msg):
+        for s in literals:
+            if s in msg:
+                return True
+        return search is not None and search(msg) is not None
+    return match
+
+
+class Filter(object):
+    def __init__(self, include=(), exclude=()):
+        include = [parse_rule(r) for r in include]
+        exclude = [parse_rule(r) for r in exclude]
+        self.has_includes = bool(include)
+
+        def values(rules, field):
+            return [v for f, v in rules if f == field]
+
+        # text= strings, for settling against format strings
+        self.include_literals = values(include, 'text')
+        self.exclude_literals = values(exclude, 'text')
+
+        self.include_format = _combine(values(include, 'format'))
+        self.exclude_format = _combine(values(exclude, 'format'))
+        self.include_text = _matcher(self.include_literals,
+                                     values(include, 'regex'))
+        self.exclude_text = _matcher(self.exclude_literals,
+                                     values(exclude, 'regex'))
+        later_includes = bool(self.include_format or self.include_text)
+        later_excludes = bool(self.exclude_format or self.exclude_text)
+
+        # indexed by stream << 8 | type byte
+        self.table = bytearray(65536)
+        # only stream 0 prints and printfs decode to anything
+        for typ in (0x10, 0x11):
+            if typ in values(exclude, 'type') or 0 in values(exclude, 'stream'):
+                continue
+            wanted = typ in values(include, 'type')
+            included = not include or wanted or 0 in values(include, 'stream')
+            if included and not later_excludes:
+                self.table[typ] = KEEP
+            elif included:
+                self.table[typ] = CHECK_INCLUDED
+            elif later_includes:
+                self.table[typ] = CHECK
+
+        # for each state, format string -> (DROP, KEEP or the state to
+        # decode in, its PrintfFormat)
+        self.formats = {KEEP: {}, CHECK: {}, CHECK_INCLUDED: {}}
+
+    def check_format(self, fmt, state):
+        # what the format string settles about a printf
+        fmt = fmt.decode('ascii', errors='replace')
+        if self.exclude_format and self.exclude_format.search(fmt):
+            return DROP
+        # text that comes out as it is, whatever the arguments
+        literal = _conversion.split(fmt)
+        if any(s in part for s in self.exclude_literals for part in literal):
+            return DROP
+        if state == CHECK:
+            wanted = self.include_format and self.include_format.search(fmt)
+            if wanted or any(s in part for s in self.include_literals
+                             for part in literal):
+                state = CHECK_INCLUDED
+        if self.exclude_text is None:
+            if state == CHECK_INCLUDED:
+                return KEEP
+            if self.include_text is None:
+                return DROP
+        return state
+
+    def decode(self, packet):
+        # the message a packet carries if the rules let it through, or None
+        # (the same checks as trace.packet_payload, without the call)
+        if len(packet) <= 13:
+            return None
+        state = self.table[packet[0] << 8 | packet[7]]
+        if state == DROP:
+            return None
+        val = packet[8]
+        if val == 0:
+            payload = packet[0x9:-5]
+        elif val == 3:
+            payload = packet[0xd:-5]
+        else:
+            return None
+
+        if packet[7] == 0x10:
+            msg = payload.decode('ascii', errors='replace')
+            if state != KEEP:
+                if self.exclude_format and self.exclude_format.search(msg):
+                    return None
+                if state == CHECK and self.include_format:
+                    if self.include_format.search(msg):
+                        state = CHECK_INCLUDED
+        else:
+            end = payload.find(b'\0')
+            if end < 0:
+                end = len(payload)
+            fmt = bytes(payload[:end])
+            formats = self.formats[state]
+            found = formats.get(fmt)
+            if found is None:
+                if len(formats) > 65536:
+                    formats.clear()
+                verdict = state
+                if state != KEEP:
+                    verdict = self.check_format(fmt, state)
+                found = formats[fmt] = (verdict, trace.compile_printf(fmt))
+            state, printf = found
+            if state == DROP:
+                return None
+            msg = printf.format(payload, end + 1)
+
+        if state == KEEP:
+            return msg
+        if self.exclude_text is not None and self.exclude_text(msg):
+            return None
+        if state == CHECK_INCLUDED or not self.has_includes:
+            return msg
+        if self.include_text is not None and self.include_text(msg):
+            return msg
+        return None
+
+
+class TextSink(object):
+    def __init__(self, fp):
+        self.fp = fp
+
+    def write(self, messages, timestamp):
+        # messages is a list of (packet, text)
+        self.fp.write(''.join(msg.strip() + '\n' for packet, msg in messages))
+
+    def close(self):
+        if self.fp is not sys.stdout:
+            self.fp.close()
+
+
+class JsonSink(TextSink):
+    def write(self, messages, timestamp):
+        self.fp.write(''.join(
+            json.dumps({'time': timestamp, 'stream': packet[0],
+                        'type': packet[7], 'text': msg.strip()}) + '\n'
+            for packet, msg in messages))
+
+
+def open_sink(spec):
+    # -, PATH or json:PATH; json:- for JSON lines on stdout
+    sink = TextSink
+    if spec.startswith('json:'):
+        sink = JsonSink
+        spec = spec[5:]
+    if spec == '-':
+        return sink(sys.stdout)
+    return sink(open(spec, 'a'))
+
+
+class Router(object):
+    """Decodes packets through a Filter and writes what passes to sinks.
+
+    Packets are taken a read at a time, and each sink is written to once
+    per batch, all with the time of the batch.
+    """
+
+    def __init__(self, filt, sinks):
+        self.filter = filt
+        self.sinks = sinks
+
+    def handle(self, packets, timestamp=None):
+        decode = self.filter.decode
+        messages = []
+        for packet in packets:
+            msg = decode(packet)
+            if msg is not None:
+                messages.append((packet, msg))
+        self.emit(messages, timestamp)
+
+    def emit(self, messages, timestamp=None):
+        if not messages:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        for sink in self.sinks:
+            sink.write(messages, timestamp)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
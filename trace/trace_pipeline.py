@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Decoding the trace on several cores.
+#
+# The reading process deframes, as trace.py does, and cuts what it reads
+# into batches of packets. Each batch goes to a pool of decoder processes
+# down a pipe, as one bytes object and the packet lengths, which pickles
+# far faster than a list of packets. The decoders filter and decode, and
+# send back only the messages that pass. Results are written out in the
+# order the batches were read, whichever decoder finishes first.
+
+import os
+import time
+import array
+import collections
+import multiprocessing
+
+import trace_filter
+
+# packets per batch handed to a decoder
+BATCH_PACKETS = 2048
+
+_filter = None
+
+
+def _init_worker(include, exclude):
+    global _filter
+    _filter = trace_filter.Filter(include, exclude)
+
+
+def pack_batch(packets):
+    lengths = array.array('L', map(len, packets))
+    return b''.join(packets), lengths.tobytes()
+
+
+def decode_batch(data, lengths):
+    # (packet header, message) for each packet in the batch that passes
+    decode = _filter.decode
+    messages = []
+    offset = 0
+    for length in array.array('L', lengths):
+        packet = data[offset:offset + length]
+        offset += length
+        msg = decode(packet)
+        if msg is not None:
+            # the sinks only look at the stream and type byte
+            messages.append((packet[:8], msg))
+    return messages
+
+
+class Pipeline(object):
+    """Decodes batches of packets in a pool of processes, in order.
+
+    handle() queues a batch and writes out any batches done by then,
+    waiting for the oldest once max_pending are outstanding; close()
+    waits for the rest.
+    """
+
+    def __init__(self, router, include=(), exclude=(), jobs=None,
+                 max_pending=None):
+        self.router = router
+        self.jobs = jobs or os.cpu_count() or 1
+        self.max_pending = max_pending or self.jobs * 4
+        self.pool = multiprocessing.Pool(self.jobs, _init_worker,
+                                         (list(include), list(exclude)))
+        # (timestamp, AsyncResult) in the order the batches were read
+        self.pending = collections.deque()
+
+    def handle(self, packets, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        for i in range(0, len(packets), BATCH_PACKETS):
+            batch = pack_batch(packets[i:i + BATCH_PACKETS])
+            self.pending.append(
+                (timestamp, self.pool.apply_async(decode_batch, batch)))
+            while self.pending:
+                full = len(self.pending) >= self.max_pending
+                if not full and not self.pending[0][1].ready():
+                    break
+                self.emit_oldest()
+
+    def emit_oldest(self):
+        timestamp, result = self.pending.popleft()
+        self.router.emit(result.get(), timestamp)
+
+    def close(self):
+        try:
+            while self.pending:
+                self.emit_oldest()
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+            self.router.close()